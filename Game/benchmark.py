@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import platform
+import argparse
+
+# Бенчмарк работает без окна, поэтому драйвер-заглушку нужно выбрать до инициализации pygame
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+import main
+
+SCENARIOS = {
+    "default": {"enemies": 10, "trees": 100},
+    "enemies_1k": {"enemies": 1000, "trees": 100},
+    "enemies_10k": {"enemies": 10000, "trees": 100},
+    "trees_50k": {"enemies": 10, "trees": 50000},
+    "inventory_open": {"enemies": 10, "trees": 100, "inventory": True},
+    "minimap": {"enemies": 10, "trees": 100, "minimap": True},
+    "horde_minimap": {"enemies": 1000, "trees": 100, "minimap": True},
+    # Вся орда в радиусе преследования, чтобы каждый враг проходил через столкновения
+    "collision": {"enemies": 1000, "trees": 10000, "cluster": True, "collision": True},
+}
+
+# Деревья и враги ставятся в квадрат вокруг игрока размером с прежнюю карту, чтобы плотность
+# сценариев не зависела от размера мира
+BENCH_AREA = 2000
+
+def area_position(game):
+    half = BENCH_AREA // 2
+    x = random.randint(max(int(game.player.x) - half, 0), min(int(game.player.x) + half, main.WORLD_WIDTH - main.TILE_SIZE))
+    y = random.randint(max(int(game.player.y) - half, 0), min(int(game.player.y) + half, main.WORLD_HEIGHT - main.TILE_SIZE))
+    return x, y
+
+def build_game(scenario, seed):
+    random.seed(seed)
+    game = main.Game(main.BotInput(seed))
+    game.start_game()
+    
+    for _ in range(scenario["trees"] - len(game.trees)):
+        game.add_tree(*area_position(game))
+    
+    for _ in range(scenario["enemies"] - len(game.enemies)):
+        if scenario.get("cluster"):
+            angle = random.uniform(0, 2 * math.pi)
+            distance = random.uniform(main.TILE_SIZE, main.ENEMY_AGGRO_RADIUS - main.TILE_SIZE)
+            x = min(max(game.player.x + math.cos(angle) * distance, 0), main.WORLD_WIDTH - main.TILE_SIZE)
+            y = min(max(game.player.y + math.sin(angle) * distance, 0), main.WORLD_HEIGHT - main.TILE_SIZE)
+        else:
+            x, y = area_position(game)
+        game.add_enemy(x, y, random.choice(main.ENEMY_TYPE_NAMES))
+    return game
+
+def keep_alive(game):
+    # Замер не должен оборваться из-за смерти игрока или конца волны
+    game.player.health = 100
+    game.player.hunger = 100
+    game.game_state = "playing"
+
+def timed(samples, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    samples.append((time.perf_counter() - start) * 1000)
+
+def summarize(samples):
+    ordered = sorted(samples)
+    count = len(ordered)
+    return {
+        "mean_ms": sum(ordered) / count,
+        "p95_ms": ordered[min(count - 1, int(count * 0.95))],
+        "p99_ms": ordered[min(count - 1, int(count * 0.99))],
+        "max_ms": ordered[-1],
+    }
+
+def run_scenario(name, scenario, ticks, seed, warmup):
+    game = build_game(scenario, seed)
+    phases = {"update": [], "draw_game": []}
+    if scenario.get("minimap"):
+        phases["minimap"] = []
+    if scenario.get("inventory"):
+        phases["inventory"] = []
+    if scenario.get("collision"):
+        phases["collision"] = []
+    
+    # Первые кадры запекают чанки и надписи, их в статистику не берем
+    for tick in range(warmup + ticks):
+        if tick == warmup:
+            for samples in phases.values():
+                samples.clear()
+        keep_alive(game)
+        for key in game.input_source.pop_key_presses():
+            game.handle_key(key)
+        collision_ms = game.collision.elapsed_ms
+        timed(phases["update"], game.update)
+        if "collision" in phases:
+            phases["collision"].append(game.collision.elapsed_ms - collision_ms)
+        
+        # Снимок состояния входит в стоимость кадра, как и в игре без отдельного потока симуляции
+        start = time.perf_counter()
+        view, _ = game.capture()
+        game.camera.update(view.player)
+        game.draw_game(view)
+        phases["draw_game"].append((time.perf_counter() - start) * 1000)
+        if "minimap" in phases:
+            timed(phases["minimap"], game.draw_minimap, view)
+        if "inventory" in phases:
+            game.inventory.visible = True
+            timed(phases["inventory"], game.inventory.draw, main.screen)
+            game.inventory.visible = False
+    
+    result = {phase: summarize(samples) for phase, samples in phases.items()}
+    # collision - часть update, в сумму кадра ее не добавляем
+    frame_phases = [samples for phase, samples in phases.items() if phase != "collision"]
+    result["frame"] = summarize([sum(frame) for frame in zip(*frame_phases)])
+    # Заполненность пулов в конце прогона: видно, хватило ли заранее выделенной емкости
+    return result, game.get_pool_stats()
+
+def compare(results, baseline, threshold):
+    # Регрессией считаем рост среднего или p95 больше чем на threshold
+    regressions = []
+    for name, phases in results.items():
+        for phase, stats in phases.items():
+            old = baseline.get(name, {}).get(phase)
+            if not old:
+                continue
+            for metric in ("mean_ms", "p95_ms"):
+                if old[metric] > 0 and stats[metric] > old[metric] * (1 + threshold):
+                    regressions.append(f"{name}.{phase}.{metric}: {old[metric]:.3f} -> {stats[metric]:.3f} мс")
+    return regressions
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Замеры update/draw на стресс-сценариях")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="можно указать несколько раз; по умолчанию все")
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None, help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+    
+    main.init_display()
+    names = args.scenario or list(SCENARIOS)
+    results = {}
+    pools = {}
+    for name in names:
+        results[name], pools[name] = run_scenario(name, SCENARIOS[name], args.ticks, args.seed, args.warmup)
+        for phase, stats in results[name].items():
+            print(f"{name:16} {phase:10} mean {stats['mean_ms']:8.3f}  p95 {stats['p95_ms']:8.3f}  "
+                  f"p99 {stats['p99_ms']:8.3f} мс")
+        for pool in ('enemies', 'resources', 'trees'):
+            stats = pools[name][pool]
+            print(f"{name:16} {pool:10} {stats['active']} из {stats['capacity']}  "
+                  f"повторно {stats['reuse_rate']:.0%}")
+    
+    report = {
+        "meta": {
+            "ticks": args.ticks,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "machine": platform.machine(),
+        },
+        "results": results,
+        "pools": pools,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Результаты записаны в {args.output}")
+    
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print("Регрессия:", line)
+        if regressions:
+            status = 1
+        else:
+            print("Регрессий относительно базового прогона нет")
+    
+    pygame.quit()
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
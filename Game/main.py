@@ -2,17 +2,62 @@ import pygame
 import random
 import math
 import time
+import os
+import argparse
+import struct
+import threading
+import json
+import gc
+import io
+import hashlib
+import copy
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
-pygame.init()
+import numpy as np
 
 SCREEN_WIDTH = 1000
 SCREEN_HEIGHT = 700
 TILE_SIZE = 50
 FPS = 60
-WORLD_WIDTH = 2000
-WORLD_HEIGHT = 2000
+CHUNK_SIZE = TILE_SIZE * 8
+# Мир заметно больше окна хранения чанков (2 * WORLD_KEEP_RADIUS + 1), иначе выгружать было бы нечего
+WORLD_CHUNKS = 16
+WORLD_WIDTH = CHUNK_SIZE * WORLD_CHUNKS
+WORLD_HEIGHT = CHUNK_SIZE * WORLD_CHUNKS
 INVENTORY_WIDTH = 5
 INVENTORY_HEIGHT = 2
+ENEMY_AGGRO_RADIUS = 400
+# Враги появляются в квадрате вокруг игрока, а не по всему миру: иначе до него почти никто не дойдет
+ENEMY_SPAWN_RANGE = 1000
+VIEW_MARGIN = TILE_SIZE
+SIM_STEP_MS = 1000 / FPS
+MAX_FRAME_MS = 250
+PLAYER_ROTATION_STEPS = 72  # 5 градусов; все 8 направлений клавиатуры попадают точно
+SPRITE_HEADINGS = 64
+MINIMAP_REFRESH_MS = 100
+# Радиусы стриминга мира в чанках вокруг чанка игрока
+WORLD_LOAD_RADIUS = 2
+WORLD_PREFETCH_RADIUS = 3
+WORLD_KEEP_RADIUS = 4
+SAVE_PATH = 'savegame.sav'
+AUTOSAVE_INTERVAL_MS = 30000
+PERF_HISTORY = 240
+PERF_HUD_REFRESH_MS = 250
+TELEMETRY_MAX_BYTES = 8 * 1024 * 1024
+TELEMETRY_BACKUPS = 3
+ASSET_CACHE_DIR = '.asset_cache'
+ASSET_LOAD_WORKERS = 4
+ATLAS_MAX_WIDTH = 1024
+# Слои очереди отрисовки в порядке вывода
+RENDER_LAYERS = ('resources', 'enemies', 'health_bars')
+# Кнопки меню, паузы и предупреждения: одни и те же прямоугольники для отрисовки, кликов и подсветки
+START_BUTTON = pygame.Rect(SCREEN_WIDTH//2 - 100, 300, 200, 50)
+CONTROLS_BUTTON = pygame.Rect(SCREEN_WIDTH//2 - 100, 370, 200, 50)
+BACK_BUTTON = pygame.Rect(SCREEN_WIDTH//2 - 100, 600, 200, 50)
+PAUSE_MENU_BUTTON = pygame.Rect(SCREEN_WIDTH//2 - 100, 400, 200, 50)
+YES_BUTTON = pygame.Rect(SCREEN_WIDTH//2 - 120, 450, 100, 40)
+NO_BUTTON = pygame.Rect(SCREEN_WIDTH//2 + 20, 450, 100, 40)
 
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
@@ -31,48 +76,407 @@ LIGHT_GRAY = (200, 200, 200)
 PURPLE = (128, 0, 128)
 LIGHT_BLUE = (173, 216, 230)
 
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("Лесной Беглец")
-clock = pygame.time.Clock()
+ENEMY_TYPE_NAMES = ['wolf', 'soldier']
+ENEMY_TYPES = {
+    'wolf': {'speed': 2, 'damage': 15, 'color': RED},
+    'soldier': {'speed': 1.5, 'damage': 20, 'color': BLUE},
+}
+ENEMY_MAX_HEALTH = 50
+
+RESOURCE_COLORS = {
+    'stick': BROWN,
+    'stone': GRAY,
+    'berry': RED,
+    'herb': GREEN,
+    'sword': PURPLE,
+    'potion': LIGHT_BLUE
+}
+RESOURCE_TYPE_NAMES = list(RESOURCE_COLORS)
+
+# Рецепты читаются из файла: предмет -> {ингредиент: количество}. Без файла остаются встроенные
+RECIPES_PATH = 'recipes.json'
+DEFAULT_RECIPES = {
+    'sword': {'stone': 2, 'stick': 1},
+    'potion': {'herb': 1},
+}
+
+# fit: 'tile' - растянуть на тайл, 'sprite' - вписать в размер персонажа с сохранением пропорций
+ASSET_MANIFEST = {
+    'grass': {
+        'file': 'grass.png',
+        'alpha': False,
+        'fit': 'tile',
+        'missing': "Не удалось загрузить текстуру травы grass.png. Будет использован зеленый фон.",
+    },
+    'player': {
+        'file': 'player.png',
+        'alpha': True,
+        'fit': 'sprite',
+        'missing': "Не удалось загрузить текстуру персонажа player.png. Будет использован треугольник.",
+    },
+}
+
+# Окно создается в init_display(); в безголовом режиме screen так и остается None
+screen = None
+clock = None
+
+def init_display():
+    # Только то, чем игра пользуется: окно с событиями и шрифты. Звука в игре нет
+    global screen, clock
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption("Лесной Беглец")
+    clock = pygame.time.Clock()
+
+def init_headless():
+    # Драйвер-заглушка SDL: окно не создается, но таймеры и события pygame работают
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pygame.display.init()
+
+class TextCache:
+    # Один объект шрифта на (семейство, размер) и LRU-кэш готовых надписей
+    def __init__(self, family='arial', max_bytes=4 * 1024 * 1024):
+        self.family = family
+        self.max_bytes = max_bytes
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get_font(self, size, family=None):
+        key = (family or self.family, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = pygame.font.SysFont(key[0], size)
+            self.fonts[key] = font
+        return font
+    
+    def render(self, text, size, color, antialias=True, family=None):
+        key = (text, size, tuple(color), antialias, family or self.family)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+        
+        self.misses += 1
+        surface = self.get_font(size, family).render(text, antialias, color)
+        surface_bytes = surface.get_pitch() * surface.get_height()
+        self.surfaces[key] = surface
+        self.used_bytes += surface_bytes
+        
+        while self.used_bytes > self.max_bytes and len(self.surfaces) > 1:
+            _, old_surface = self.surfaces.popitem(last=False)
+            self.used_bytes -= old_surface.get_pitch() * old_surface.get_height()
+        return surface
+    
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+text_cache = TextCache()
+
+class AssetCache:
+    # Картинки из манифеста декодируются и масштабируются в фоновых потоках, а результат
+    # кладется на диск сырыми пикселями с ключом по хэшу исходного файла. Следующий запуск
+    # читает готовые пиксели без декодирования PNG; на главном потоке остается только convert
+    VERSION = 1
+    
+    def __init__(self, manifest=ASSET_MANIFEST, cache_dir=ASSET_CACHE_DIR, workers=ASSET_LOAD_WORKERS):
+        self.manifest = manifest
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        
+    def target_size(self, entry, size):
+        if entry['fit'] == 'tile':
+            return TILE_SIZE, TILE_SIZE
+        scale_factor = (TILE_SIZE - 10) / max(size)
+        return int(size[0] * scale_factor), int(size[1] * scale_factor)
+    
+    def cache_path(self, name, data, entry):
+        key = f"{self.VERSION}:{TILE_SIZE}:{entry['fit']}:{entry['alpha']}".encode()
+        digest = hashlib.sha1(key + data).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}-{digest}.bin")
+    
+    def read_cached(self, path, entry):
+        with open(path, 'rb') as f:
+            data = f.read()
+        width, height = struct.unpack_from('<II', data)
+        pixel_format = 'RGBA' if entry['alpha'] else 'RGB'
+        return pygame.image.frombytes(data[8:], (width, height), pixel_format)
+    
+    def write_cached(self, path, surface, entry):
+        pixel_format = 'RGBA' if entry['alpha'] else 'RGB'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(struct.pack('<II', *surface.get_size()))
+                f.write(pygame.image.tobytes(surface, pixel_format))
+            os.replace(temp_path, path)
+        except OSError as e:
+            # Кэш - только ускорение: без прав на запись просто грузим как раньше
+            print(f"Не удалось сохранить кэш текстуры {entry['file']}: {e}")
+            
+    def prepare(self, name, entry):
+        # Выполняется в рабочем потоке: чтение, декодирование и масштабирование без convert
+        with open(entry['file'], 'rb') as f:
+            data = f.read()
+        path = self.cache_path(name, data, entry)
+        if os.path.exists(path):
+            try:
+                return self.read_cached(path, entry), True
+            except (OSError, pygame.error, ValueError, struct.error) as e:
+                # Обрезанный или битый файл кэша: картинку декодируем заново и запись перезаписываем
+                print(f"Кэш текстуры {entry['file']} поврежден, файл будет пересоздан: {e}")
+        
+        surface = pygame.image.load(io.BytesIO(data), entry['file'])
+        surface = pygame.transform.scale(surface, self.target_size(entry, surface.get_size()))
+        self.write_cached(path, surface, entry)
+        return surface, False
+    
+    def load_all(self):
+        textures = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="assets") as pool:
+            futures = {name: pool.submit(self.prepare, name, entry) for name, entry in self.manifest.items()}
+            for name, future in futures.items():
+                entry = self.manifest[name]
+                try:
+                    surface, cached = future.result()
+                except (OSError, pygame.error, ValueError, struct.error):
+                    print(entry['missing'])
+                    textures[name] = None
+                    continue
+                
+                if cached:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                if pygame.display.get_surface():
+                    surface = surface.convert_alpha() if entry['alpha'] else surface.convert()
+                textures[name] = surface
+        return textures
 
 class TextureManager:
-    def __init__(self):
+    def __init__(self, load=True, rotation_steps=PLAYER_ROTATION_STEPS):
         self.grass_texture = None
         self.player_texture = None
-        self.load_textures()
+        self.rotation_steps = rotation_steps
+        self.player_rotations = {}
+        self.sprites = None
+        self.atlas = None
+        self.assets = AssetCache()
+        if load:
+            self.load_textures()
+            self.sprites = SpriteSheets()
+            self.atlas = TextureAtlas(self)
     
     def load_textures(self):
-        try:
-            self.grass_texture = pygame.image.load('grass.png').convert()
-            self.grass_texture = pygame.transform.scale(self.grass_texture, (TILE_SIZE, TILE_SIZE))
-        except:
-            print("Не удалось загрузить текстуру травы grass.png. Будет использован зеленый фон.")
-            self.grass_texture = None
+        textures = self.assets.load_all()
+        self.grass_texture = textures['grass']
+        self.player_texture = textures['player']
+        self.player_rotations.clear()
+    
+    def get_rotated_player(self, direction):
+        # Угол квантуется до rotation_steps положений, каждое поворачивается один раз и дальше берется из словаря
+        step = 360 / self.rotation_steps
+        index = round(-math.degrees(direction) / step) % self.rotation_steps
+        rotated = self.player_rotations.get(index)
+        if rotated is None:
+            rotated = pygame.transform.rotate(self.player_texture, index * step)
+            self.player_rotations[index] = rotated
+        return rotated
+    
+    def fill_grass(self, surface):
+        # Поверхность должна начинаться на границе тайла, тогда трава стыкуется между чанками
+        width, height = surface.get_size()
+        atlas = self.atlas
+        surface.blits([(atlas.surface, (x, y), atlas.grass_area)
+                       for x in range(0, width, TILE_SIZE) for y in range(0, height, TILE_SIZE)], doreturn=False)
+
+class SimClock:
+    # Единое время симуляции: логика идет фиксированными шагами, кадры только копят прошедшее время
+    def __init__(self, step_ms=SIM_STEP_MS, max_frame_ms=MAX_FRAME_MS):
+        self.step_ms = step_ms
+        self.max_frame_ms = max_frame_ms
+        self.time_ms = 0.0
+        self.ticks = 0
+        self.accumulator = 0.0
+        self.max_speed_steps = None  # режим "максимальная скорость": N шагов на каждый кадр
+        
+    def now(self):
+        return self.time_ms
+    
+    def tick(self):
+        self.ticks += 1
+        self.time_ms = self.ticks * self.step_ms
+        
+    def advance(self, frame_ms):
+        # Сколько шагов симуляции выполнить за этот кадр
+        if self.max_speed_steps:
+            self.accumulator = 0.0
+            return self.max_speed_steps
+        
+        # Очень долгий кадр обрезаем, иначе догоняющие шаги сами будут тормозить следующий кадр
+        self.accumulator += min(frame_ms, self.max_frame_ms)
+        steps = int(self.accumulator // self.step_ms)
+        self.accumulator -= steps * self.step_ms
+        return steps
+    
+    def alpha(self):
+        # Доля шага, прошедшая после последнего тика, для интерполяции при отрисовке
+        return self.accumulator / self.step_ms
+
+class SpriteSheets:
+    # Треугольники врагов и запасной треугольник игрока рисуются один раз для каждого из
+    # headings направлений, полоски здоровья - для каждой ширины в пикселях
+    def __init__(self, headings=SPRITE_HEADINGS):
+        self.headings = headings
+        self.size = TILE_SIZE - 10
+        self.pad = 2
+        self.enemies = []
+        for name in ENEMY_TYPE_NAMES:
+            color = ENEMY_TYPES[name]['color']
+            self.enemies.append([self.render_triangle(color, self.heading_angle(i), False)
+                                 for i in range(headings)])
+        self.player = [self.render_triangle(ORANGE, self.heading_angle(i), True) for i in range(headings)]
+        
+        self.health_bar_width = 40
+        self.health_bars = []
+        for width in range(self.health_bar_width + 1):
+            bar = pygame.Surface((self.health_bar_width, 5))
+            bar.fill(DARK_RED)
+            bar.fill(RED, (0, 0, width, 5))
+            self.health_bars.append(bar)
+            
+    def heading_angle(self, index):
+        return index * 2 * math.pi / self.headings
+    
+    def heading_index(self, direction):
+        return round(direction * self.headings / (2 * math.pi)) % self.headings
+    
+    def heading_indices(self, directions):
+        return np.rint(directions * (self.headings / (2 * np.pi))).astype(np.int64) % self.headings
+    
+    def render_triangle(self, color, direction, with_eye):
+        # Та же геометрия, что раньше рисовалась каждый кадр, но относительно угла спрайта
+        surface = pygame.Surface((self.size + self.pad * 2, self.size + self.pad * 2), pygame.SRCALPHA)
+        center = self.size // 2 + self.pad
+        points = []
+        for offset in (0, 2.5, -2.5):
+            points.append((center + math.cos(direction + offset) * self.size // 2,
+                           center + math.sin(direction + offset) * self.size // 2))
+        pygame.draw.polygon(surface, color, points)
         
-        try:
-            self.player_texture = pygame.image.load('player.png').convert_alpha()
-            original_size = self.player_texture.get_size()
-            scale_factor = (TILE_SIZE - 10) / max(original_size)
-            new_width = int(original_size[0] * scale_factor)
-            new_height = int(original_size[1] * scale_factor)
-            self.player_texture = pygame.transform.scale(self.player_texture, (new_width, new_height))
-        except:
-            print("Не удалось загрузить текстуру персонажа player.png. Будет использован треугольник.")
-            self.player_texture = None
-    
-    def draw_grass_background(self, screen, camera):
-        if self.grass_texture:
-            start_x = int(camera.x // TILE_SIZE) * TILE_SIZE
-            start_y = int(camera.y // TILE_SIZE) * TILE_SIZE
-            
-            for x in range(start_x, start_x + SCREEN_WIDTH + TILE_SIZE, TILE_SIZE):
-                for y in range(start_y, start_y + SCREEN_HEIGHT + TILE_SIZE, TILE_SIZE):
-                    screen_x = x - camera.x
-                    screen_y = y - camera.y
-                    if -TILE_SIZE <= screen_x <= SCREEN_WIDTH and -TILE_SIZE <= screen_y <= SCREEN_HEIGHT:
-                        screen.blit(self.grass_texture, (screen_x, screen_y))
+        if with_eye:
+            eye_size = self.size // 8
+            eye_x = center + math.cos(direction) * self.size // 3
+            eye_y = center + math.sin(direction) * self.size // 3
+            pygame.draw.circle(surface, WHITE, (int(eye_x), int(eye_y)), eye_size)
+            pygame.draw.circle(surface, BLACK, (int(eye_x), int(eye_y)), eye_size // 2)
+        return surface
+
+class TextureAtlas:
+    # Все спрайты мира на одной поверхности: трава, дерево, ресурсы, враги, запасной треугольник
+    # игрока и полоски здоровья. Рисование - это blit нужной области атласа
+    def __init__(self, texture_manager, max_width=ATLAS_MAX_WIDTH):
+        sprites = texture_manager.sprites
+        self.sprites = sprites
+        self.pad = sprites.pad
+        self.tree_pad = 10
+        self.resource_pad = 5
+        pieces = []
+        
+        grass = pygame.Surface((TILE_SIZE, TILE_SIZE), pygame.SRCALPHA)
+        if texture_manager.grass_texture:
+            grass.blit(texture_manager.grass_texture, (0, 0))
+        else:
+            grass.fill(GRASS_GREEN)
+        pieces.append(('grass', grass))
+        
+        # Дерево и ресурсы рисуются своими же методами draw, с запасом на выступающие части
+        origin = Camera()
+        tree = pygame.Surface((Tree.width + self.tree_pad * 2, Tree.height + self.tree_pad * 2), pygame.SRCALPHA)
+        Tree(self.tree_pad, self.tree_pad).draw(tree, origin)
+        pieces.append(('tree', tree))
+        for res_type in RESOURCE_TYPE_NAMES:
+            resource = pygame.Surface((Resource.size + self.resource_pad * 2,) * 2, pygame.SRCALPHA)
+            Resource(self.resource_pad, self.resource_pad, res_type).draw(resource, origin)
+            pieces.append((('resource', res_type), resource))
+            
+        for type_id, sheet in enumerate(sprites.enemies):
+            for heading, surface in enumerate(sheet):
+                pieces.append((('enemy', type_id, heading), surface))
+        for heading, surface in enumerate(sprites.player):
+            pieces.append((('player', heading), surface))
+        for width, surface in enumerate(sprites.health_bars):
+            pieces.append((('health_bar', width), surface))
+            
+        areas = self.pack(pieces, max_width)
+        self.grass_area = areas['grass']
+        self.tree_area = areas['tree']
+        self.resource_areas = {res_type: areas[('resource', res_type)] for res_type in RESOURCE_TYPE_NAMES}
+        self.enemy_areas = [[areas[('enemy', type_id, heading)] for heading in range(len(sheet))]
+                            for type_id, sheet in enumerate(sprites.enemies)]
+        self.player_areas = [areas[('player', heading)] for heading in range(len(sprites.player))]
+        self.health_bar_areas = [areas[('health_bar', width)] for width in range(len(sprites.health_bars))]
+        
+    def pack(self, pieces, max_width):
+        # Простая укладка полками: слева направо, новая полка - когда строка заполнена
+        areas = {}
+        x = y = shelf_height = 0
+        for key, surface in pieces:
+            width, height = surface.get_size()
+            if x + width > max_width:
+                x = 0
+                y += shelf_height + 1
+                shelf_height = 0
+            areas[key] = pygame.Rect(x, y, width, height)
+            x += width + 1
+            shelf_height = max(shelf_height, height)
+            
+        self.surface = pygame.Surface((max_width, y + shelf_height), pygame.SRCALPHA)
+        for key, surface in pieces:
+            self.surface.blit(surface, areas[key])
+        if pygame.display.get_surface():
+            self.surface = self.surface.convert_alpha()
+        return areas
+
+class RenderQueue:
+    # За кадр собирает (поверхность, позиция, область) по слоям и отдает каждый слой одним blits.
+    # Для слоев из sort_layers элементы перед выводом сортируются по y, чтобы нижние перекрывали верхние
+    def __init__(self, layers=RENDER_LAYERS, sort_layers=()):
+        self.order = list(layers)
+        self.layers = {name: [] for name in layers}
+        self.sort_layers = set(sort_layers)
+        self.submitted = 0
+        self.batches = 0
+        
+    def add(self, layer, source, dest, area=None):
+        if area is None:
+            self.layers[layer].append((source, dest))
         else:
-            screen.fill(GRASS_GREEN)
+            self.layers[layer].append((source, dest, area))
+            
+    def extend(self, layer, items):
+        self.layers[layer].extend(items)
+        
+    def flush(self, screen):
+        for name in self.order:
+            items = self.layers[name]
+            if not items:
+                continue
+            if name in self.sort_layers:
+                items.sort(key=lambda item: item[1][1])
+            screen.blits(items, doreturn=False)
+            self.submitted += len(items)
+            self.batches += 1
+            items.clear()
 
 class Camera:
     def __init__(self):
@@ -80,15 +484,735 @@ class Camera:
         self.y = 0
         self.width = SCREEN_WIDTH
         self.height = SCREEN_HEIGHT
+        self.alpha = 1.0
+        self.sim_tick = 0
         
     def update(self, target):
-        self.x = target.x - SCREEN_WIDTH // 2 + target.size // 2
-        self.y = target.y - SCREEN_HEIGHT // 2 + target.size // 2
+        target_x, target_y = self.interpolate(target)
+        self.x = target_x - SCREEN_WIDTH // 2 + target.size // 2
+        self.y = target_y - SCREEN_HEIGHT // 2 + target.size // 2
         self.x = max(0, min(self.x, WORLD_WIDTH - SCREEN_WIDTH))
         self.y = max(0, min(self.y, WORLD_HEIGHT - SCREEN_HEIGHT))
         
     def apply(self, entity):
         return entity.x - self.x, entity.y - self.y
+    
+    def interpolate(self, entity):
+        # Положение между двумя последними шагами; если объект на последнем шаге не двигался - текущее
+        if entity.last_step != self.sim_tick:
+            return entity.x, entity.y
+        return (entity.prev_x + (entity.x - entity.prev_x) * self.alpha,
+                entity.prev_y + (entity.y - entity.prev_y) * self.alpha)
+    
+    def apply_interpolated(self, entity):
+        x, y = self.interpolate(entity)
+        return x - self.x, y - self.y
+
+class SpatialGrid:
+    # Равномерная сетка: ячейка -> объекты, в ней лежащие (по левому верхнему углу)
+    def __init__(self, cell_size=TILE_SIZE * 2):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entity_cells = {}
+        self.last_visited = 0
+    
+    def cell_of(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+    
+    def insert(self, entity):
+        key = self.cell_of(entity.x, entity.y)
+        self.cells.setdefault(key, {})[entity] = None
+        self.entity_cells[entity] = key
+    
+    def remove(self, entity):
+        key = self.entity_cells.pop(entity, None)
+        if key is None:
+            return False
+        cell = self.cells[key]
+        del cell[entity]
+        if not cell:
+            del self.cells[key]
+        return True
+    
+    def move(self, entity):
+        old_key = self.entity_cells.get(entity)
+        new_key = self.cell_of(entity.x, entity.y)
+        if old_key == new_key:
+            return
+        if old_key is not None:
+            cell = self.cells[old_key]
+            del cell[entity]
+            if not cell:
+                del self.cells[old_key]
+        self.cells.setdefault(new_key, {})[entity] = None
+        self.entity_cells[entity] = new_key
+    
+    
+    def __len__(self):
+        return len(self.entity_cells)
+    
+    def query_rect(self, x, y, width, height):
+        min_cx, min_cy = self.cell_of(x, y)
+        max_cx, max_cy = self.cell_of(x + width, y + height)
+        result = []
+        visited = 0
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                cell = self.cells.get((cx, cy))
+                if not cell:
+                    continue
+                visited += len(cell)
+                for entity in cell:
+                    if x <= entity.x < x + width and y <= entity.y < y + height:
+                        result.append(entity)
+        self.last_visited = visited
+        return result
+    
+    def query_view(self, camera, margin=VIEW_MARGIN):
+        # Только то, что попадает в экран камеры с запасом на выступающие части спрайтов
+        return self.query_rect(camera.x - margin, camera.y - margin,
+                               camera.width + margin * 2, camera.height + margin * 2)
+    
+    def query_radius(self, x, y, radius):
+        min_cx, min_cy = self.cell_of(x - radius, y - radius)
+        max_cx, max_cy = self.cell_of(x + radius, y + radius)
+        radius_sq = radius * radius
+        result = []
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                cell = self.cells.get((cx, cy))
+                if not cell:
+                    continue
+                for entity in cell:
+                    dx = entity.x - x
+                    dy = entity.y - y
+                    if dx * dx + dy * dy < radius_sq:
+                        result.append(entity)
+        return result
+
+class FlowField:
+    # Общая карта путей к игроку на сетке тайлов: клетки, центр которых ближе радиуса врага к стволу,
+    # закрыты, расстояние считается одной волной от клетки игрока. Волна идет только по окну размером
+    # с радиус агрессии вокруг игрока - враги дальше него не преследуют и поле не читают. Враг только
+    # смотрит на соседние клетки своей клетки и идет в ту, что ближе к игроку, так что поиск пути
+    # не зависит от числа врагов
+    OFFSETS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+    UNREACHABLE = 1 << 30
+    
+    def __init__(self, width=WORLD_WIDTH, height=WORLD_HEIGHT, cell_size=TILE_SIZE, radius=ENEMY_AGGRO_RADIUS):
+        self.cell_size = cell_size
+        self.cols = math.ceil(width / cell_size)
+        self.rows = math.ceil(height / cell_size)
+        # Две клетки запаса, чтобы обход дерева на краю радиуса не упирался в край окна
+        self.reach = math.ceil(radius / cell_size) + 2
+        self.blocked = np.zeros((self.rows, self.cols), dtype=np.int32)
+        self.distance = np.full((self.rows, self.cols), self.UNREACHABLE, dtype=np.int64)
+        self.neighbour_distance = np.full((self.rows, self.cols, len(self.OFFSETS)), self.UNREACHABLE, dtype=np.int64)
+        lengths = [math.hypot(dx, dy) for dx, dy in self.OFFSETS]
+        self.unit_x = np.array([dx / length for (dx, _), length in zip(self.OFFSETS, lengths)])
+        self.unit_y = np.array([dy / length for (_, dy), length in zip(self.OFFSETS, lengths)])
+        self.target = None
+        self.window = None
+        self.written = None
+        self.walk = None
+        self.dirty = True
+        self.opened = False
+        self.recomputes = 0
+        
+    def cell_of(self, x, y):
+        col = min(max(int(x // self.cell_size), 0), self.cols - 1)
+        row = min(max(int(y // self.cell_size), 0), self.rows - 1)
+        return col, row
+    
+    def cells_of_box(self, left, top, right, bottom):
+        # Клетки, центр которых лежит внутри прямоугольника
+        half = self.cell_size / 2
+        min_col = max(math.floor((left - half) / self.cell_size) + 1, 0)
+        min_row = max(math.floor((top - half) / self.cell_size) + 1, 0)
+        max_col = min(math.ceil((right - half) / self.cell_size) - 1, self.cols - 1)
+        max_row = min(math.ceil((bottom - half) / self.cell_size) - 1, self.rows - 1)
+        return slice(min_row, max_row + 1), slice(min_col, max_col + 1)
+    
+    def block(self, left, top, right, bottom):
+        # Закрываются клетки, в центре которых враг уже упирался бы в ствол: враги идут от центра
+        # к центру, так что у открытых клеток зазор до ствола не меньше радиуса
+        cells = self.cells_of_box(left, top, right, bottom)
+        self.blocked[cells] += 1
+        # Деревья за окном на поле не влияют: окно и так соберется заново, когда игрок к ним подойдет
+        if self.in_window(cells):
+            self.dirty = True
+            
+    def unblock(self, left, top, right, bottom):
+        cells = self.cells_of_box(left, top, right, bottom)
+        self.blocked[cells] -= 1
+        if self.in_window(cells):
+            self.opened = True
+            
+    def in_window(self, cells):
+        if self.window is None:
+            return False
+        return all(part.start < part.stop and part.start < window.stop and window.start < part.stop
+                   for part, window in zip(cells, self.window))
+    
+    def update(self, x, y):
+        # Волна заново - когда игрок перешел в другую клетку или в окне закрылись клетки.
+        # Открывшиеся клетки расстояния только уменьшают, их достаточно дораспространить
+        cell = self.cell_of(x, y)
+        if cell != self.target or self.dirty:
+            self.recompute(cell)
+        elif self.opened:
+            self.relax()
+            
+    def arrivals(self, free):
+        # Для каждого смещения - клетки, в которые можно прийти этим шагом. По диагонали можно пройти,
+        # только если обе соседние по сторонам клетки свободны. За краем окна все считается закрытым
+        rows, cols = free.shape
+        padded_free = np.zeros((rows + 2, cols + 2), dtype=bool)
+        padded_free[1:-1, 1:-1] = free
+        allowed = []
+        for dx, dy in self.OFFSETS:
+            arrive = free.copy()
+            if dx and dy:
+                arrive &= padded_free[1 - dy:1 - dy + rows, 1:-1]
+                arrive &= padded_free[1:-1, 1 - dx:1 - dx + cols]
+            allowed.append(arrive)
+        return padded_free, allowed
+    
+    def window_free(self):
+        free = self.blocked[self.window] == 0
+        col, row = self.target
+        free[row - self.window[0].start, col - self.window[1].start] = True
+        return free
+    
+    def recompute(self, cell):
+        self.target = cell
+        self.dirty = False
+        self.opened = False
+        self.recomputes += 1
+        col, row = cell
+        top, left = max(row - self.reach, 0), max(col - self.reach, 0)
+        self.window = (slice(top, min(row + self.reach + 1, self.rows)),
+                       slice(left, min(col + self.reach + 1, self.cols)))
+        free = self.window_free()
+        rows, cols = free.shape
+        row -= top
+        col -= left
+        padded_free, allowed = self.arrivals(free)
+        
+        # Волна BFS целиком на массивах: за итерацию фронт расширяется на одну клетку во все 8 сторон
+        padded_frontier = np.zeros((rows + 2, cols + 2), dtype=bool)
+        moves = [(padded_frontier[1 - dy:1 - dy + rows, 1 - dx:1 - dx + cols], arrive)
+                 for (dx, dy), arrive in zip(self.OFFSETS, allowed)]
+        distance = np.full((rows, cols), self.UNREACHABLE, dtype=np.int64)
+        distance[row, col] = 0
+        visited = np.zeros((rows, cols), dtype=bool)
+        visited[row, col] = True
+        padded_frontier[1 + row, 1 + col] = True
+        reached = np.zeros_like(visited)
+        step_mask = np.zeros_like(visited)
+        step = 0
+        while True:
+            reached[:] = False
+            for source, arrive in moves:
+                np.logical_and(source, arrive, out=step_mask)
+                reached |= step_mask
+            reached &= ~visited
+            if not reached.any():
+                break
+            step += 1
+            distance[reached] = step
+            visited |= reached
+            padded_frontier[1:-1, 1:-1] = reached
+        self.finish(free, padded_free, distance)
+        
+    def relax(self):
+        # Дораспространение от прежних расстояний: клетка берет минимум по соседям, из которых в нее
+        # можно прийти, пока что-то уменьшается. Итераций столько, насколько далеко дошло улучшение
+        self.opened = False
+        free = self.window_free()
+        rows, cols = free.shape
+        padded_free, allowed = self.arrivals(free)
+        distance = self.walk.copy()
+        padded_distance = np.full((rows + 2, cols + 2), self.UNREACHABLE, dtype=np.int64)
+        best = np.empty_like(distance)
+        while True:
+            padded_distance[1:-1, 1:-1] = distance
+            best[:] = self.UNREACHABLE
+            for (dx, dy), arrive in zip(self.OFFSETS, allowed):
+                source = padded_distance[1 - dy:1 - dy + rows, 1 - dx:1 - dx + cols]
+                np.minimum(best, np.where(arrive, source, self.UNREACHABLE), out=best)
+            improved = best + 1 < distance
+            if not improved.any():
+                break
+            distance[improved] = best[improved] + 1
+        self.finish(free, padded_free, distance)
+        
+    def finish(self, free, padded_free, distance):
+        self.walk = distance.copy()
+        rows, cols = free.shape
+        
+        # Закрытые клетки получают расстояние выхода: каждый слой от открытых клеток стоит больше
+        # любого пути по открытым, поэтому враг у ствола сначала выходит в ближайшую открытую клетку
+        exit_cost = rows * cols
+        padded_distance = np.full((rows + 2, cols + 2), self.UNREACHABLE, dtype=np.int64)
+        pending = ~free
+        best = np.empty_like(distance)
+        while True:
+            padded_distance[1:-1, 1:-1] = distance
+            best[:] = self.UNREACHABLE
+            for dx, dy in self.OFFSETS:
+                np.minimum(best, padded_distance[1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols], out=best)
+            layer = pending & (best < self.UNREACHABLE)
+            if not layer.any():
+                break
+            distance[layer] = best[layer] + exit_cost
+            pending &= ~layer
+        # Вне окна поле всегда UNREACHABLE, поэтому стирать достаточно прошлое окно, а не весь мир
+        if self.written is not None:
+            self.distance[self.written] = self.UNREACHABLE
+            self.neighbour_distance[self.written] = self.UNREACHABLE
+        self.written = self.window
+        self.distance[self.window] = distance
+        
+        # Из открытой клетки можно только в открытую (по диагонали - еще и мимо открытых углов),
+        # из закрытой - в любую соседнюю
+        neighbour_distance = self.neighbour_distance[self.window]
+        for k, (dx, dy) in enumerate(self.OFFSETS):
+            neighbour = padded_distance[1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols]
+            allowed = padded_free[1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols].copy()
+            if dx and dy:
+                allowed &= padded_free[1:-1, 1 + dx:1 + dx + cols]
+                allowed &= padded_free[1 + dy:1 + dy + rows, 1:-1]
+            neighbour_distance[:, :, k] = np.where(allowed | ~free, neighbour, self.UNREACHABLE)
+            
+    def steer(self, center_x, center_y, direct_x, direct_y, heading):
+        # Идем в соседа с наименьшим расстоянием; среди равных - в того, что ближе к направлению
+        # на игрока и к текущему курсу (иначе в симметричных местах враг дрожит на месте).
+        # Из закрытой клетки уходим в соседнюю, откуда есть путь. Рядом с игроком или без пути
+        # враг идет напрямую
+        cols = np.clip((center_x // self.cell_size).astype(np.int64), 0, self.cols - 1)
+        rows = np.clip((center_y // self.cell_size).astype(np.int64), 0, self.rows - 1)
+        own = self.distance[rows, cols]
+        neighbours = self.neighbour_distance[rows, cols]
+        
+        score = (self.unit_x * direct_x[:, None] + self.unit_y * direct_y[:, None] +
+                 0.5 * (self.unit_x * np.cos(heading)[:, None] + self.unit_y * np.sin(heading)[:, None]) -
+                 4.0 * np.minimum(neighbours, own[:, None]))
+        score = np.where(neighbours < own[:, None], score, -np.inf)
+        best = np.argmax(score, axis=1)
+        use_field = np.isfinite(score[np.arange(best.size), best]) & (own > 1)
+        # Целимся в центр выбранной клетки, а не вдоль сетки: путь между центрами свободных клеток
+        # не задевает стволы, а из закрытой клетки так выходят, не цепляя угол
+        offsets = np.array(self.OFFSETS)
+        target_x = (cols + offsets[best, 0] + 0.5) * self.cell_size - center_x
+        target_y = (rows + offsets[best, 1] + 0.5) * self.cell_size - center_y
+        length = np.maximum(np.sqrt(target_x * target_x + target_y * target_y), 1e-9)
+        return (np.where(use_field, target_x / length, direct_x),
+                np.where(use_field, target_y / length, direct_y))
+
+class CollisionSystem:
+    # Все подвижные объекты - круги одного радиуса (игрок и враги одного размера), деревья - прямоугольники
+    # стволов. Широкая фаза для деревьев: ствол, расширенный на радиус, записывается во все клетки,
+    # которые он задевает, поэтому объекту достаточно одной клетки своего центра. Для расталкивания
+    # врагов сетка строится заново каждый шаг сортировкой. Все пары обрабатываются массивами
+    def __init__(self, radius=(TILE_SIZE - 10) / 2, cell_size=TILE_SIZE // 2, separation=0.5):
+        self.radius = radius
+        self.cell_size = cell_size
+        self.separation = separation
+        self.cols = math.ceil(WORLD_WIDTH / cell_size) + 1
+        self.rows = math.ceil(WORLD_HEIGHT / cell_size) + 1
+        self.trees = {}
+        self.dirty = True
+        self.box_left = self.box_top = self.box_right = self.box_bottom = np.zeros(0)
+        self.cell_start = np.zeros(self.rows * self.cols + 1, dtype=np.int64)
+        self.slot_boxes = np.zeros((0, 4), dtype=np.float32)
+        self.elapsed_ms = 0.0
+        self.contacts = 0
+        
+    @staticmethod
+    def tree_box(tree):
+        # Сталкиваемся только со стволом: крона нависает сверху и проходима
+        left = tree.x + tree.width // 3
+        top = tree.y + tree.height // 2
+        return left, top, left + tree.width // 3, tree.y + tree.height
+    
+    def inflated_box(self, tree):
+        # Ствол, расширенный на радиус: область, куда не может попасть центр движущегося объекта
+        left, top, right, bottom = self.tree_box(tree)
+        return left - self.radius, top - self.radius, right + self.radius, bottom + self.radius
+    
+    def add_tree(self, tree):
+        self.trees[tree] = self.tree_box(tree)
+        self.dirty = True
+        
+    def remove_tree(self, tree):
+        del self.trees[tree]
+        self.dirty = True
+        
+    def cell_range(self, low, high, limit):
+        return (np.clip((low // self.cell_size).astype(np.int64), 0, limit - 1),
+                np.clip((high // self.cell_size).astype(np.int64), 0, limit - 1))
+    
+    def rebuild(self):
+        # Деревья меняются только при подгрузке чанков, так что раскладка пересчитывается редко
+        self.dirty = False
+        boxes = np.array(list(self.trees.values()), dtype=np.float64).reshape(-1, 4)
+        self.box_left, self.box_top, self.box_right, self.box_bottom = (boxes[:, i].copy() for i in range(4))
+        
+        min_cx, max_cx = self.cell_range(self.box_left - self.radius, self.box_right + self.radius, self.cols)
+        min_cy, max_cy = self.cell_range(self.box_top - self.radius, self.box_bottom + self.radius, self.rows)
+        ids = np.arange(len(boxes))
+        keys, trees = [], []
+        span_x = int((max_cx - min_cx).max(initial=0)) + 1
+        span_y = int((max_cy - min_cy).max(initial=0)) + 1
+        for offset_y in range(span_y):
+            for offset_x in range(span_x):
+                valid = (min_cx + offset_x <= max_cx) & (min_cy + offset_y <= max_cy)
+                keys.append(((min_cy + offset_y) * self.cols + min_cx + offset_x)[valid])
+                trees.append(ids[valid])
+        keys = np.concatenate(keys)
+        order = np.argsort(keys, kind='stable')
+        # Прямоугольники раскладываются прямо по ячейкам строками, чтобы брать их одним take
+        self.slot_boxes = boxes[np.concatenate(trees)[order]].astype(np.float32)
+        self.cell_start = np.searchsorted(keys[order], np.arange(self.rows * self.cols + 1))
+        
+    @staticmethod
+    def expand(owners, starts, counts):
+        # Пары (владелец, позиция) для диапазонов starts[i]..starts[i]+counts[i]
+        total = int(counts.sum())
+        shift = starts - (np.cumsum(counts) - counts)
+        return np.repeat(owners, counts), np.repeat(shift, counts) + np.arange(total)
+    
+    def push_out_of_trees(self, center_x, center_y):
+        if self.dirty:
+            self.rebuild()
+        n = center_x.size
+        if not self.box_left.size:
+            return center_x, center_y
+        # Обычное деление с отбрасыванием дробной части: // для float в numpy в разы медленнее,
+        # а отрицательные координаты все равно прижимаются к нулю
+        cell_x = np.clip((center_x / self.cell_size).astype(np.int64), 0, self.cols - 1)
+        cell_y = np.clip((center_y / self.cell_size).astype(np.int64), 0, self.rows - 1)
+        keys = cell_y * self.cols + cell_x
+        starts = self.cell_start[keys]
+        counts = self.cell_start[keys + 1] - starts
+        # Объекты в ячейках без стволов не проверяются вовсе
+        near = np.flatnonzero(counts)
+        if not near.size:
+            return center_x, center_y
+        movers, slots = self.expand(near, starts[near], counts[near])
+        
+        # Пары считаются во float32: точности на координатах мира хватает с запасом, а проходы
+        # по массивам пар заметно быстрее. Сдвиги все равно складываются в float64
+        mx = center_x.astype(np.float32)[movers]
+        my = center_y.astype(np.float32)[movers]
+        left, top, right, bottom = np.take(self.slot_boxes, slots, axis=0).T
+        offset_x = mx - np.minimum(np.maximum(mx, left), right)
+        offset_y = my - np.minimum(np.maximum(my, top), bottom)
+        dist_sq = offset_x * offset_x + offset_y * offset_y
+        hit = np.flatnonzero(dist_sq < self.radius * self.radius)
+        if not hit.size:
+            return center_x, center_y
+        self.contacts += hit.size
+        movers, slots, offset_x, offset_y = movers[hit], slots[hit], offset_x[hit], offset_y[hit]
+        
+        dist = np.sqrt(dist_sq[hit])
+        outside = dist > 0
+        scale = (self.radius - dist) / np.maximum(dist, 1e-12)
+        push_x = offset_x * scale
+        push_y = offset_y * scale
+        
+        # Центр внутри ствола: выталкиваем по оси наименьшего проникновения
+        inside = np.flatnonzero(~outside)
+        if inside.size:
+            mx = center_x[movers[inside]].astype(np.float32)
+            my = center_y[movers[inside]].astype(np.float32)
+            left, top, right, bottom = np.take(self.slot_boxes, slots[inside], axis=0).T
+            exits = np.stack([mx - left, right - mx, my - top, bottom - my]) + self.radius
+            axis = np.argmin(exits, axis=0)
+            depth = exits[axis, np.arange(inside.size)]
+            push_x[inside] = np.select([axis == 0, axis == 1], [-depth, depth], 0)
+            push_y[inside] = np.select([axis == 2, axis == 3], [-depth, depth], 0)
+            
+        return (center_x + np.bincount(movers, weights=push_x, minlength=n),
+                center_y + np.bincount(movers, weights=push_y, minlength=n))
+    
+    def separate(self, center_x, center_y):
+        # Мягкое расталкивание: каждая пересекающаяся пара расходится на долю separation перекрытия.
+        # Соседние клетки берутся "половиной": своя (только объекты после текущего в порядке сортировки)
+        # и четыре соседние вперед, так каждая пара встречается ровно один раз. После сортировки
+        # своя клетка и следующая справа лежат подряд, как и три клетки ряда ниже - это два диапазона
+        n = center_x.size
+        if n < 2:
+            return center_x, center_y
+        size = self.radius * 2
+        # Сетка покрывает только прямоугольник, занятый объектами, а не весь мир, и имеет запас
+        # в одну клетку по краям, чтобы соседи крайних клеток не выходили за массив
+        cell_x = (center_x / size).astype(np.int64)
+        cell_y = (center_y / size).astype(np.int64)
+        cell_x -= cell_x.min() - 1
+        cell_y -= cell_y.min() - 1
+        width = int(cell_x.max()) + 2
+        height = int(cell_y.max()) + 2
+        keys = cell_y * width + cell_x
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        ends = np.cumsum(np.bincount(keys, minlength=width * height))
+        
+        # Дальше все считается в порядке сортировки, first и second - позиции в нем
+        position = np.arange(n)
+        below = ends[keys + width - 2]
+        first, second = self.expand(np.concatenate([position, position]),
+                                    np.concatenate([position + 1, below]),
+                                    np.concatenate([ends[keys + 1] - position - 1, ends[keys + width + 1] - below]))
+        # Пары, как и со стволами, считаются во float32
+        sorted_x = center_x[order].astype(np.float32)
+        sorted_y = center_y[order].astype(np.float32)
+        offset_x = sorted_x[second] - sorted_x[first]
+        offset_y = sorted_y[second] - sorted_y[first]
+        dist_sq = offset_x * offset_x + offset_y * offset_y
+        hit = np.flatnonzero(dist_sq < size * size)
+        if not hit.size:
+            return center_x, center_y
+        first, second = order[first[hit]], order[second[hit]]
+        offset_x, offset_y, dist = offset_x[hit], offset_y[hit], np.sqrt(dist_sq[hit])
+        
+        # Совпавшие центры разводим по x, чтобы не делить на ноль
+        coincident = dist == 0
+        offset_x = np.where(coincident, 1.0, offset_x)
+        dist = np.where(coincident, 1.0, dist)
+        amount = (size - dist) * self.separation / 2 / dist
+        push_x = offset_x * amount
+        push_y = offset_y * amount
+        return (center_x + np.bincount(second, weights=push_x, minlength=n) - np.bincount(first, weights=push_x, minlength=n),
+                center_y + np.bincount(second, weights=push_y, minlength=n) - np.bincount(first, weights=push_y, minlength=n))
+    
+    def resolve_movers(self, center_x, center_y):
+        # Деревья разрешаются последними: расталкивание не должно загонять в ствол
+        start = time.perf_counter()
+        center_x, center_y = self.separate(center_x, center_y)
+        center_x, center_y = self.push_out_of_trees(center_x, center_y)
+        self.elapsed_ms += (time.perf_counter() - start) * 1000
+        return center_x, center_y
+    
+    def resolve_circle(self, x, y):
+        center_x, center_y = self.push_out_of_trees(np.array([x], dtype=np.float64),
+                                                    np.array([y], dtype=np.float64))
+        return float(center_x[0]), float(center_y[0])
+
+class KeyboardInput:
+    # Источник ввода для обычной игры: движение по зажатым клавишам, нажатия приходят событиями
+    def get_movement(self):
+        keys = pygame.key.get_pressed()
+        dx, dy = 0, 0
+        
+        if keys[pygame.K_w] or keys[pygame.K_UP]:
+            dy = -1
+        if keys[pygame.K_s] or keys[pygame.K_DOWN]:
+            dy = 1
+        if keys[pygame.K_a] or keys[pygame.K_LEFT]:
+            dx = -1
+        if keys[pygame.K_d] or keys[pygame.K_RIGHT]:
+            dx = 1
+        return dx, dy
+    
+    def pop_key_presses(self):
+        return []
+
+class ScriptedInput:
+    # Ввод, который задается кодом: для безголовой симуляции и тестов
+    def __init__(self, movement=(0, 0)):
+        self.movement = movement
+        self.pending_keys = []
+        
+    def get_movement(self):
+        return self.movement
+    
+    def press(self, key):
+        self.pending_keys.append(key)
+        
+    def pop_key_presses(self):
+        keys = self.pending_keys
+        self.pending_keys = []
+        return keys
+
+class BotInput(ScriptedInput):
+    # Случайно бродит по миру, атакует и собирает ресурсы - для нагрузочных прогонов
+    def __init__(self, seed=None, turn_interval=60):
+        super().__init__()
+        self.rng = random.Random(seed)
+        self.turn_interval = turn_interval
+        self.ticks = 0
+        
+    def get_movement(self):
+        if self.ticks % self.turn_interval == 0:
+            self.movement = (self.rng.choice((-1, 0, 1)), self.rng.choice((-1, 0, 1)))
+        self.ticks += 1
+        return self.movement
+    
+    def pop_key_presses(self):
+        keys = super().pop_key_presses()
+        if self.rng.random() < 0.1:
+            keys.append(pygame.K_SPACE)
+        if self.rng.random() < 0.05:
+            keys.append(pygame.K_e)
+        if self.rng.random() < 0.01:
+            keys.append(pygame.K_r)
+        return keys
+
+class InputRecording:
+    # Сессия = seed глобального random, seed мира, движение на каждом шаге симуляции,
+    # нажатия игровых клавиш и крафт с номером шага, перед которым они были обработаны.
+    # У крафта еще хранится число нажатий до него, чтобы при повторе сохранить порядок действий
+    KEYS = (pygame.K_e, pygame.K_SPACE, pygame.K_r, pygame.K_h, pygame.K_p, pygame.K_1, pygame.K_2)
+    MAGIC = b'GTRP'
+    VERSION = 2
+    
+    def __init__(self, seed, world_seed):
+        self.seed = seed
+        self.world_seed = world_seed
+        self.movement = []
+        self.presses = []
+        self.crafts = []
+        
+    def __len__(self):
+        return len(self.movement)
+    
+    def record_movement(self, dx, dy):
+        self.movement.append((dx, dy))
+        
+    def record_key(self, tick, key):
+        self.presses.append((tick, key))
+        
+    def record_craft(self, tick, recipe, times):
+        self.crafts.append((tick, recipe, times, len(self.presses)))
+        
+    def actions(self):
+        # Нажатия и крафт одним списком (шаг, действие) в том порядке, в котором они были сделаны
+        crafts = iter(self.crafts)
+        craft = next(crafts, None)
+        result = []
+        for index, (tick, key) in enumerate(self.presses + [(None, None)]):
+            while craft is not None and craft[3] <= index:
+                result.append((craft[0], ('craft', craft[1], craft[2])))
+                craft = next(crafts, None)
+            if key is not None:
+                result.append((tick, ('key', key)))
+        return result
+        
+    def save(self, path):
+        out = SaveWriter()
+        out.pack('4sHqqII', self.MAGIC, self.VERSION, self.seed, self.world_seed,
+                 len(self.movement), len(self.presses))
+        out.array(self.movement, np.int8)
+        out.array(self.presses, np.int32)
+        out.pack('I', len(self.crafts))
+        for tick, recipe, times, order in self.crafts:
+            out.string(recipe)
+            out.pack('3i', tick, times, order)
+        with open(path, 'wb') as f:
+            f.write(out.getvalue())
+            
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            reader = SaveReader(f.read())
+        magic, version, seed, world_seed, ticks, presses = reader.unpack('4sHqqII')
+        if magic != cls.MAGIC:
+            raise ValueError("Это не запись сессии")
+        if version != cls.VERSION:
+            raise ValueError(f"Неподдерживаемая версия записи: {version}")
+        recording = cls(seed, world_seed)
+        recording.movement = [tuple(step) for step in reader.array(ticks * 2, np.int8).reshape(ticks, 2).tolist()]
+        recording.presses = [tuple(press) for press in reader.array(presses * 2, np.int32).reshape(presses, 2).tolist()]
+        for _ in range(reader.unpack('I')[0]):
+            recipe = reader.string()
+            tick, times, order = reader.unpack('3i')
+            recording.crafts.append((tick, recipe, times, order))
+        return recording
+
+class ReplayInput(ScriptedInput):
+    # Проигрывает InputRecording шаг за шагом; действия отдаются перед тем шагом, перед которым были сделаны
+    def __init__(self, recording):
+        super().__init__()
+        self.recording = recording
+        self.tick = 0
+        self.actions_by_tick = {}
+        for tick, action in recording.actions():
+            self.actions_by_tick.setdefault(tick, []).append(action)
+            
+    def finished(self):
+        return self.tick >= len(self.recording)
+    
+    def get_movement(self):
+        movement = self.recording.movement[self.tick]
+        self.tick += 1
+        return movement
+    
+    def pop_actions(self):
+        return self.actions_by_tick.pop(self.tick, [])
+    
+    def pop_key_presses(self):
+        return [action[1] for action in self.pop_actions() if action[0] == 'key']
+
+class ItemStorage:
+    # Предметы игрока. Каждое изменение увеличивает version, и все, что нарисовано по инвентарю,
+    # можно кэшировать до смены версии. Чтение - как у словаря
+    def __init__(self, items=None):
+        self.counts = dict(items or {})
+        self.version = 0
+        self.listeners = []
+        
+    def subscribe(self, listener):
+        # listener(items) получает изменившиеся предметы; None - заменено все содержимое
+        self.listeners.append(listener)
+        
+    def notify(self, items):
+        self.version += 1
+        for listener in self.listeners:
+            listener(items)
+        
+    def get(self, item, default=0):
+        return self.counts.get(item, default)
+    
+    def __getitem__(self, item):
+        return self.counts[item]
+    
+    def __contains__(self, item):
+        return item in self.counts
+    
+    def __iter__(self):
+        return iter(self.counts)
+    
+    def __len__(self):
+        return len(self.counts)
+    
+    def keys(self):
+        return self.counts.keys()
+    
+    def items(self):
+        return self.counts.items()
+    
+    def add(self, item, count=1):
+        self.counts[item] = self.counts.get(item, 0) + count
+        self.notify((item,))
+        
+    def remove(self, item, count=1):
+        if self.counts.get(item, 0) < count:
+            return False
+        self.counts[item] -= count
+        self.notify((item,))
+        return True
+    
+    def apply(self, changes):
+        # Несколько изменений {предмет: +-количество} одной операцией и одним уведомлением
+        for item, delta in changes.items():
+            self.counts[item] = self.counts.get(item, 0) + delta
+        self.notify(tuple(changes))
+    
+    def replace(self, items):
+        self.counts = dict(items)
+        self.notify(None)
 
 class Player:
     def __init__(self, x, y, texture_manager):
@@ -100,13 +1224,16 @@ class Player:
         self.hunger = 100
         self.energy = 100
         self.direction = 0
-        self.inventory = {'stick': 3, 'stone': 2, 'berry': 5, 'herb': 2, 'sword': 0, 'potion': 0}
+        self.inventory = ItemStorage({'stick': 3, 'stone': 2, 'berry': 5, 'herb': 2, 'sword': 0, 'potion': 0})
         self.equipped = None
         self.texture_manager = texture_manager
         self.last_damage_time = 0
         self.damage_cooldown = 1000
+        self.prev_x = x
+        self.prev_y = y
+        self.last_step = 0
         
-    def move(self, dx, dy):
+    def move(self, dx, dy, collision=None):
         if dx != 0 or dy != 0:
             self.direction = math.atan2(dy, dx)
             
@@ -118,8 +1245,13 @@ class Player:
         if 0 <= new_y <= WORLD_HEIGHT - self.size:
             self.y = new_y
             
-    def take_damage(self, damage):
-        current_time = pygame.time.get_ticks()
+        if collision is not None:
+            half = self.size / 2
+            center_x, center_y = collision.resolve_circle(self.x + half, self.y + half)
+            self.x = min(max(center_x - half, 0), WORLD_WIDTH - self.size)
+            self.y = min(max(center_y - half, 0), WORLD_HEIGHT - self.size)
+            
+    def take_damage(self, damage, current_time):
         if current_time - self.last_damage_time > self.damage_cooldown:
             self.health = max(0, self.health - damage)
             self.last_damage_time = current_time
@@ -127,37 +1259,22 @@ class Player:
         return False
             
     def use_potion(self):
-        if self.inventory.get('potion', 0) > 0:
+        if self.inventory.remove('potion'):
             self.health = min(100, self.health + 40)
-            self.inventory['potion'] -= 1
             return True
         return False
                 
     def draw(self, screen, camera):
-        screen_x, screen_y = camera.apply(self)
+        screen_x, screen_y = camera.apply_interpolated(self)
         
         if self.texture_manager.player_texture:
-            rotated_texture = pygame.transform.rotate(self.texture_manager.player_texture, -math.degrees(self.direction))
+            rotated_texture = self.texture_manager.get_rotated_player(self.direction)
             texture_rect = rotated_texture.get_rect(center=(screen_x + self.size // 2, screen_y + self.size // 2))
             screen.blit(rotated_texture, texture_rect)
         else:
-            points = []
-            front_x = screen_x + self.size // 2 + math.cos(self.direction) * self.size // 2
-            front_y = screen_y + self.size // 2 + math.sin(self.direction) * self.size // 2
-            back_left_x = screen_x + self.size // 2 + math.cos(self.direction + 2.5) * self.size // 2
-            back_left_y = screen_y + self.size // 2 + math.sin(self.direction + 2.5) * self.size // 2
-            back_right_x = screen_x + self.size // 2 + math.cos(self.direction - 2.5) * self.size // 2
-            back_right_y = screen_y + self.size // 2 + math.sin(self.direction - 2.5) * self.size // 2
-            
-            points = [(front_x, front_y), (back_left_x, back_left_y), (back_right_x, back_right_y)]
-            
-            pygame.draw.polygon(screen, ORANGE, points)
-            
-            eye_size = self.size // 8
-            eye_x = screen_x + self.size // 2 + math.cos(self.direction) * self.size // 3
-            eye_y = screen_y + self.size // 2 + math.sin(self.direction) * self.size // 3
-            pygame.draw.circle(screen, WHITE, (int(eye_x), int(eye_y)), eye_size)
-            pygame.draw.circle(screen, BLACK, (int(eye_x), int(eye_y)), eye_size // 2)
+            atlas = self.texture_manager.atlas
+            area = atlas.player_areas[atlas.sprites.heading_index(self.direction)]
+            screen.blit(atlas.surface, (screen_x - atlas.pad, screen_y - atlas.pad), area)
         
         if self.equipped == 'sword':
             sword_length = self.size * 1.5
@@ -167,74 +1284,325 @@ class Player:
                            (screen_x + self.size // 2, screen_y + self.size // 2),
                            (sword_x, sword_y), 3)
 
+def pool_field(name):
+    # Свойство, которое читает и пишет ячейку массива пула по индексу объекта
+    def getter(self):
+        return getattr(self.pool, name)[self.index]
+    
+    def setter(self, value):
+        getattr(self.pool, name)[self.index] = value
+    return property(getter, setter)
+
 class Enemy:
-    def __init__(self, x, y, enemy_type):
-        self.x = x
-        self.y = y
-        self.size = TILE_SIZE - 10
-        self.type = enemy_type
-        self.speed = 2 if enemy_type == 'wolf' else 1.5
-        self.health = 50
-        self.damage = 15 if enemy_type == 'wolf' else 20
-        self.color = RED if enemy_type == 'wolf' else BLUE
-        self.direction = 0
-        self.last_attack_time = 0
-        self.attack_cooldown = 2000
-        
-    def update(self, player):
-        dx = player.x - self.x
-        dy = player.y - self.y
-        dist = max(1, math.sqrt(dx*dx + dy*dy))
-        
-        if dist < 400:
-            dx, dy = dx/dist, dy/dist
-            self.direction = math.atan2(dy, dx)
-            self.x += dx * self.speed
-            self.y += dy * self.speed
+    # Сам враг ничего не хранит: все его данные лежат в массивах EnemyPool по индексу
+    __slots__ = ('pool', 'index')
+    size = TILE_SIZE - 10
+    
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        
+    x = pool_field('x')
+    y = pool_field('y')
+    prev_x = pool_field('prev_x')
+    prev_y = pool_field('prev_y')
+    last_step = pool_field('last_step')
+    speed = pool_field('speed')
+    health = pool_field('health')
+    damage = pool_field('damage')
+    direction = pool_field('direction')
+    last_attack_time = pool_field('last_attack_time')
+    attack_cooldown = pool_field('attack_cooldown')
+    
+    @property
+    def type(self):
+        return ENEMY_TYPE_NAMES[self.pool.type_id[self.index]]
+    
+    @property
+    def color(self):
+        return ENEMY_TYPES[self.type]['color']
+
+class EnemyPool:
+    # Все враги в виде структуры массивов NumPy: погоня, проверка агрессии и атаки считаются
+    # одним векторным шагом, а не методом на каждого врага
+    FLOAT_FIELDS = ('x', 'y', 'prev_x', 'prev_y', 'speed', 'health', 'damage', 'direction',
+                    'last_attack_time', 'attack_cooldown')
+    INT_FIELDS = ('type_id', 'last_step', 'cell_x', 'cell_y')
+    # Клетки сетки при загрузке считаются заново, сохранять их незачем
+    SAVE_FIELDS = FLOAT_FIELDS + ('type_id', 'last_step')
+    
+    def __init__(self, grid, capacity=64):
+        self.grid = grid
+        self.capacity = capacity
+        self.count = 0
+        self.handles = []
+        self.free_handles = []
+        self.spawned = 0
+        self.reused = 0
+        for name in self.FLOAT_FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=np.float64))
+        for name in self.INT_FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=np.int64))
             
-        if dist < TILE_SIZE:
-            self.attack(player)
-        
-    def attack(self, player):
-        current_time = pygame.time.get_ticks()
-        if current_time - self.last_attack_time > self.attack_cooldown:
-            if player.take_damage(self.damage):
-                self.last_attack_time = current_time
-        
-    def draw(self, screen, camera):
-        screen_x, screen_y = camera.apply(self)
-        
-        points = []
-        front_x = screen_x + self.size // 2 + math.cos(self.direction) * self.size // 2
-        front_y = screen_y + self.size // 2 + math.sin(self.direction) * self.size // 2
-        back_left_x = screen_x + self.size // 2 + math.cos(self.direction + 2.5) * self.size // 2
-        back_left_y = screen_y + self.size // 2 + math.sin(self.direction + 2.5) * self.size // 2
-        back_right_x = screen_x + self.size // 2 + math.cos(self.direction - 2.5) * self.size // 2
-        back_right_y = screen_y + self.size // 2 + math.sin(self.direction - 2.5) * self.size // 2
-        
-        points = [(front_x, front_y), (back_left_x, back_left_y), (back_right_x, back_right_y)]
-        
-        pygame.draw.polygon(screen, self.color, points)
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        return iter(self.handles)
+    
+    def grow(self):
+        new_capacity = self.capacity * 2
+        for name in self.FLOAT_FIELDS + self.INT_FIELDS:
+            old = getattr(self, name)
+            new = np.zeros(new_capacity, dtype=old.dtype)
+            new[:self.capacity] = old
+            setattr(self, name, new)
+        self.capacity = new_capacity
+        
+    def spawn(self, x, y, enemy_type):
+        if self.count == self.capacity:
+            self.grow()
+        i = self.count
+        stats = ENEMY_TYPES[enemy_type]
+        self.x[i] = self.prev_x[i] = x
+        self.y[i] = self.prev_y[i] = y
+        self.speed[i] = stats['speed']
+        self.health[i] = ENEMY_MAX_HEALTH
+        self.damage[i] = stats['damage']
+        self.direction[i] = 0
+        self.last_attack_time[i] = 0
+        self.attack_cooldown[i] = 2000
+        self.type_id[i] = ENEMY_TYPE_NAMES.index(enemy_type)
+        self.last_step[i] = 0
+        self.cell_x[i], self.cell_y[i] = self.grid.cell_of(x, y)
+        
+        # Объекты-ссылки убитых врагов переиспользуются, чтобы спавн не создавал мусор для GC
+        if self.free_handles:
+            enemy = self.free_handles.pop()
+            enemy.pool = self
+            enemy.index = i
+            self.reused += 1
+        else:
+            enemy = Enemy(self, i)
+        self.spawned += 1
+        self.handles.append(enemy)
+        self.count += 1
+        self.grid.insert(enemy)
+        return enemy
+    
+    def remove(self, enemy):
+        # Последний враг переезжает на место удаленного, так что удаление O(1)
+        self.grid.remove(enemy)
+        i = enemy.index
+        last = self.count - 1
+        if i != last:
+            for name in self.FLOAT_FIELDS + self.INT_FIELDS:
+                array = getattr(self, name)
+                array[i] = array[last]
+            moved = self.handles[last]
+            moved.index = i
+            self.handles[i] = moved
+        self.handles.pop()
+        self.count -= 1
+        enemy.pool = None
+        enemy.index = -1
+        self.free_handles.append(enemy)
+        
+    def snapshot(self):
+        n = self.count
+        return {name: getattr(self, name)[:n].copy() for name in self.SAVE_FIELDS}
+    
+    def restore(self, fields):
+        for enemy in list(self.handles):
+            self.remove(enemy)
+        n = len(fields['x'])
+        while self.capacity < n:
+            self.grow()
+        for name in self.SAVE_FIELDS:
+            getattr(self, name)[:n] = fields[name]
+            
+        for i in range(n):
+            self.cell_x[i], self.cell_y[i] = self.grid.cell_of(self.x[i], self.y[i])
+            enemy = self.free_handles.pop() if self.free_handles else Enemy(self, i)
+            enemy.pool = self
+            enemy.index = i
+            self.handles.append(enemy)
+            self.count += 1
+            self.grid.insert(enemy)
+            
+    def get_stats(self):
+        return {
+            'active': self.count,
+            'capacity': self.capacity,
+            'occupancy': self.count / self.capacity,
+            'reuse_rate': self.reused / self.spawned if self.spawned else 0.0,
+        }
         
-        if self.health < 50:
-            health_width = 40
-            pygame.draw.rect(screen, DARK_RED, (screen_x, screen_y - 10, health_width, 5))
-            pygame.draw.rect(screen, RED, (screen_x, screen_y - 10, health_width * (self.health / 50), 5))
+    def update(self, player, clock, flow_field=None, collision=None):
+        n = self.count
+        if n == 0:
+            return
+        x = self.x[:n]
+        y = self.y[:n]
+        
+        dx = player.x - x
+        dy = player.y - y
+        dist = np.maximum(1, np.sqrt(dx * dx + dy * dy))
+        
+        chasing = np.flatnonzero(dist < ENEMY_AGGRO_RADIUS)
+        if chasing.size:
+            self.prev_x[chasing] = x[chasing]
+            self.prev_y[chasing] = y[chasing]
+            self.last_step[chasing] = clock.ticks
+            
+            step_x = dx[chasing] / dist[chasing]
+            step_y = dy[chasing] / dist[chasing]
+            if flow_field is not None:
+                # Поле нужно только преследующим, так что и пересчитывается только при них
+                flow_field.update(player.x + player.size / 2, player.y + player.size / 2)
+                half = Enemy.size / 2
+                step_x, step_y = flow_field.steer(x[chasing] + half, y[chasing] + half, step_x, step_y,
+                                                  self.direction[chasing])
+            self.direction[chasing] = np.arctan2(step_y, step_x)
+            x[chasing] += step_x * self.speed[chasing]
+            y[chasing] += step_y * self.speed[chasing]
+            if collision is not None:
+                half = Enemy.size / 2
+                center_x, center_y = collision.resolve_movers(x[chasing] + half, y[chasing] + half)
+                # Расталкивание может вынести за край мира - прижимаем, как и игрока
+                x[chasing] = np.clip(center_x - half, 0, WORLD_WIDTH - Enemy.size)
+                y[chasing] = np.clip(center_y - half, 0, WORLD_HEIGHT - Enemy.size)
+            
+            # В сетке перекладываем только тех, кто перешел в другую ячейку
+            cell_x = (x[chasing] // self.grid.cell_size).astype(np.int64)
+            cell_y = (y[chasing] // self.grid.cell_size).astype(np.int64)
+            changed = (cell_x != self.cell_x[chasing]) | (cell_y != self.cell_y[chasing])
+            if changed.any():
+                moved = chasing[changed]
+                self.cell_x[moved] = cell_x[changed]
+                self.cell_y[moved] = cell_y[changed]
+                for i in moved.tolist():
+                    self.grid.move(self.handles[i])
+                    
+        # Кулдаун игрока зависит от порядка ударов, поэтому сами удары идут по одному
+        now = clock.now()
+        ready = (dist < TILE_SIZE) & (now - self.last_attack_time[:n] > self.attack_cooldown[:n])
+        for i in np.flatnonzero(ready).tolist():
+            if player.take_damage(self.damage[i], now):
+                self.last_attack_time[i] = now
+
+class EnemySnapshot:
+    # Копия массивов EnemyPool на момент шага, только для чтения: ее рисуют, пока считается следующий шаг
+    FIELDS = ('x', 'y', 'prev_x', 'prev_y', 'direction', 'health', 'type_id', 'last_step')
+    
+    def __init__(self, pool):
+        self.count = pool.count
+        for name in self.FIELDS:
+            values = getattr(pool, name)[:pool.count].copy()
+            values.flags.writeable = False
+            setattr(self, name, values)
+            
+    def __len__(self):
+        return self.count
+    
+    def draw(self, queue, camera, atlas, margin=VIEW_MARGIN):
+        # Позиции, отсечение по камере и выбор спрайта считаются по массивам,
+        # а в очередь отрисовки уходят области атласа
+        n = self.count
+        x = self.x[:n]
+        y = self.y[:n]
+        stepped = self.last_step[:n] == camera.sim_tick
+        x = np.where(stepped, self.prev_x[:n] + (x - self.prev_x[:n]) * camera.alpha, x)
+        y = np.where(stepped, self.prev_y[:n] + (y - self.prev_y[:n]) * camera.alpha, y)
+        screen_x = x - camera.x
+        screen_y = y - camera.y
+        
+        visible = np.flatnonzero((screen_x >= -margin) & (screen_x < camera.width + margin)
+                                 & (screen_y >= -margin) & (screen_y < camera.height + margin))
+        if visible.size == 0:
+            return 0
+        
+        screen_x = screen_x[visible].astype(np.int64)
+        screen_y = screen_y[visible].astype(np.int64)
+        headings = atlas.sprites.heading_indices(self.direction[visible])
+        type_ids = self.type_id[visible]
+        
+        source = atlas.surface
+        areas = atlas.enemy_areas
+        sprite_x = (screen_x - atlas.pad).tolist()
+        sprite_y = (screen_y - atlas.pad).tolist()
+        queue.extend('enemies', [(source, (sx, sy), areas[type_id][heading])
+                                 for type_id, heading, sx, sy in zip(type_ids.tolist(), headings.tolist(), sprite_x, sprite_y)])
+        
+        health = self.health[visible]
+        wounded = np.flatnonzero(health < ENEMY_MAX_HEALTH)
+        if wounded.size:
+            bar_width = atlas.sprites.health_bar_width
+            widths = (bar_width * health[wounded] / ENEMY_MAX_HEALTH).astype(np.int64)
+            widths = np.clip(widths, 0, bar_width).tolist()
+            bars = atlas.health_bar_areas
+            queue.extend('health_bars', [(source, (bx, by - 10), bars[width])
+                                         for width, bx, by in zip(widths, screen_x[wounded].tolist(),
+                                                                  screen_y[wounded].tolist())])
+        return visible.size
+
+class ObjectPool:
+    # Живые объекты лежат плотным списком (удаление - перестановкой последнего на место удаленного),
+    # удаленные копятся в списке свободных и переиспользуются через reset()
+    def __init__(self, factory):
+        self.factory = factory
+        self.active = []
+        self.free = []
+        self.acquired = 0
+        self.reused = 0
+        
+    def __len__(self):
+        return len(self.active)
+        
+    def acquire(self, *args):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args)
+            self.reused += 1
+        else:
+            obj = self.factory(*args)
+        self.acquired += 1
+        obj.slot = len(self.active)
+        self.active.append(obj)
+        return obj
+    
+    def release(self, obj):
+        last = self.active.pop()
+        if last is not obj:
+            self.active[obj.slot] = last
+            last.slot = obj.slot
+        obj.slot = -1
+        self.free.append(obj)
+        
+    def get_stats(self):
+        total = len(self.active) + len(self.free)
+        return {
+            'active': len(self.active),
+            'capacity': total,
+            'occupancy': len(self.active) / total if total else 0.0,
+            'reuse_rate': self.reused / self.acquired if self.acquired else 0.0,
+        }
 
 class Resource:
-    def __init__(self, x, y, res_type):
+    __slots__ = ('x', 'y', 'type', 'origin', 'slot')
+    size = TILE_SIZE - 15
+    colors = RESOURCE_COLORS
+    
+    def __init__(self, x, y, res_type, origin=None):
+        self.slot = -1
+        self.reset(x, y, res_type, origin)
+        
+    def reset(self, x, y, res_type, origin=None):
         self.x = x
         self.y = y
-        self.size = TILE_SIZE - 15
         self.type = res_type
-        self.colors = {
-            'stick': BROWN,
-            'stone': GRAY,
-            'berry': RED,
-            'herb': GREEN,
-            'sword': PURPLE,
-            'potion': LIGHT_BLUE
-        }
+        # (чанк, номер) для ресурсов, созданных генератором мира
+        self.origin = origin
         
     def draw(self, screen, camera):
         screen_x, screen_y = camera.apply(self)
@@ -252,11 +1620,17 @@ class Resource:
             pygame.draw.rect(screen, color, (screen_x, screen_y, self.size, self.size))
 
 class Tree:
+    __slots__ = ('x', 'y', 'slot')
+    width = TILE_SIZE
+    height = TILE_SIZE
+    
     def __init__(self, x, y):
+        self.slot = -1
+        self.reset(x, y)
+        
+    def reset(self, x, y):
         self.x = x
         self.y = y
-        self.width = TILE_SIZE
-        self.height = TILE_SIZE
         
     def draw(self, screen, camera):
         screen_x, screen_y = camera.apply(self)
@@ -266,6 +1640,147 @@ class Tree:
                           (screen_x + self.width//2, screen_y + self.height//3), 
                           self.width//2)
 
+class TerrainCache:
+    # Трава и деревья не меняются, поэтому каждый чанк мира рисуется один раз в отдельную поверхность
+    def __init__(self, texture_manager, tree_grid, lock, max_bytes=16 * 1024 * 1024):
+        self.texture_manager = texture_manager
+        self.tree_grid = tree_grid
+        self.lock = lock
+        self.max_bytes = max_bytes
+        self.chunks = OrderedDict()
+        self.used_bytes = 0
+        self.bakes = 0
+        self.hits = 0
+        self.origin = Camera()
+        
+    def bake_chunk(self, cx, cy):
+        surface = pygame.Surface((CHUNK_SIZE, CHUNK_SIZE))
+        if pygame.display.get_surface():
+            surface = surface.convert()
+        self.texture_manager.fill_grass(surface)
+        
+        self.origin.x = cx * CHUNK_SIZE
+        self.origin.y = cy * CHUNK_SIZE
+        # Дерево может выступать за свой чанк, поэтому берем соседей с запасом в тайл
+        # Сетку деревьев правит поток симуляции, поэтому читаем ее под его блокировкой
+        atlas = self.texture_manager.atlas
+        with self.lock:
+            trees = self.tree_grid.query_rect(self.origin.x - TILE_SIZE, self.origin.y - TILE_SIZE,
+                                              CHUNK_SIZE + TILE_SIZE * 2, CHUNK_SIZE + TILE_SIZE * 2)
+        batch = []
+        for tree in trees:
+            tree_x, tree_y = self.origin.apply(tree)
+            batch.append((atlas.surface, (tree_x - atlas.tree_pad, tree_y - atlas.tree_pad), atlas.tree_area))
+        surface.blits(batch, doreturn=False)
+            
+        self.bakes += 1
+        return surface
+    
+    def get_chunk(self, cx, cy):
+        key = (cx, cy)
+        surface = self.chunks.get(key)
+        if surface is None:
+            surface = self.bake_chunk(cx, cy)
+            self.chunks[key] = surface
+            self.used_bytes += surface.get_pitch() * surface.get_height()
+        else:
+            self.chunks.move_to_end(key)
+            self.hits += 1
+        return surface
+    
+    def hit_rate(self):
+        total = self.hits + self.bakes
+        return self.hits / total if total else 0.0
+    
+    def invalidate(self, x, y, width, height):
+        min_cx = int((x - TILE_SIZE) // CHUNK_SIZE)
+        min_cy = int((y - TILE_SIZE) // CHUNK_SIZE)
+        max_cx = int((x + width + TILE_SIZE) // CHUNK_SIZE)
+        max_cy = int((y + height + TILE_SIZE) // CHUNK_SIZE)
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                surface = self.chunks.pop((cx, cy), None)
+                if surface is not None:
+                    self.used_bytes -= surface.get_pitch() * surface.get_height()
+    
+    def draw(self, screen, camera):
+        min_cx = int(camera.x // CHUNK_SIZE)
+        min_cy = int(camera.y // CHUNK_SIZE)
+        max_cx = int((camera.x + camera.width - 1) // CHUNK_SIZE)
+        max_cy = int((camera.y + camera.height - 1) // CHUNK_SIZE)
+        
+        visible = 0
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                surface = self.get_chunk(cx, cy)
+                screen.blit(surface, (cx * CHUNK_SIZE - camera.x, cy * CHUNK_SIZE - camera.y))
+                visible += 1
+                
+        # Вытесняем давно не использованные чанки, но не те, что видны прямо сейчас
+        while self.used_bytes > self.max_bytes and len(self.chunks) > visible:
+            _, surface = self.chunks.popitem(last=False)
+            self.used_bytes -= surface.get_pitch() * surface.get_height()
+
+def load_recipes(path=RECIPES_PATH):
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        recipes = {}
+        for item, ingredients in data.items():
+            if not ingredients or not all(isinstance(count, int) and count > 0 for count in ingredients.values()):
+                raise ValueError(f"неверный рецепт {item}")
+            recipes[item] = dict(ingredients)
+        return recipes
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"Не удалось загрузить рецепты {path}: {e}. Будут использованы встроенные.")
+        return {item: dict(ingredients) for item, ingredients in DEFAULT_RECIPES.items()}
+
+class CraftingEngine:
+    # Для каждого рецепта хранится, сколько раз его можно скрафтить прямо сейчас. Инвентарь сообщает,
+    # какие предметы изменились, и по обратному индексу ингредиент -> рецепты пересчитываются
+    # только рецепты с этими ингредиентами, а не весь список
+    def __init__(self, storage, recipes):
+        self.storage = storage
+        self.recipes = recipes
+        self.recipes_by_ingredient = {}
+        for recipe, ingredients in recipes.items():
+            for item in ingredients:
+                self.recipes_by_ingredient.setdefault(item, []).append(recipe)
+        self.max_crafts = {}
+        self.craftable = set()
+        self.recount(recipes)
+        storage.subscribe(self.on_change)
+        
+    def recount(self, recipes):
+        storage = self.storage
+        for recipe in recipes:
+            times = min(storage.get(item, 0) // count for item, count in self.recipes[recipe].items())
+            self.max_crafts[recipe] = times
+            if times > 0:
+                self.craftable.add(recipe)
+            else:
+                self.craftable.discard(recipe)
+                
+    def on_change(self, items):
+        if items is None:
+            self.recount(self.recipes)
+            return
+        affected = set()
+        for item in items:
+            affected.update(self.recipes_by_ingredient.get(item, ()))
+        self.recount(affected)
+        
+    def craft(self, recipe, times=1):
+        # times=None - столько, на сколько хватит ингредиентов; возвращает, сколько скрафчено
+        available = self.max_crafts.get(recipe, 0)
+        times = available if times is None else min(times, available)
+        if times <= 0:
+            return 0
+        changes = {item: -count * times for item, count in self.recipes[recipe].items()}
+        changes[recipe] = changes.get(recipe, 0) + times
+        self.storage.apply(changes)
+        return times
+
 class Inventory:
     def __init__(self, player):
         self.player = player
@@ -275,141 +1790,187 @@ class Inventory:
         self.height = INVENTORY_HEIGHT * self.cell_size
         self.x = (SCREEN_WIDTH - self.width) // 2
         self.y = (SCREEN_HEIGHT - self.height) // 2
-        self.crafting_recipes = {
-            'sword': {'stone': 2, 'stick': 1},
-            'potion': {'herb': 1}
-        }
+        self.crafting = CraftingEngine(player.inventory, load_recipes())
+        self.panel = None
+        self.panel_version = None
+        self.item_cells = []
+        self.craft_buttons = []
         
     def toggle(self):
         self.visible = not self.visible
         
+    def build_panel(self):
+        # Сетка, предметы и список рецептов зависят только от инвентаря, поэтому рисуются
+        # в одну поверхность и перестраиваются при смене его версии
+        inventory = self.player.inventory
+        recipes = []
+        for recipe, ingredients in self.crafting.recipes.items():
+            ingredient_text = f"{recipe}: " + "".join(f"{item} x{count} " for item, count in ingredients.items())
+            times = self.crafting.max_crafts[recipe]
+            recipes.append((recipe, times, text_cache.render(ingredient_text, 16, GREEN if times else RED)))
+        
+        recipe_top = self.height + 10
+        # Крайние линии сетки лежат на x = width и y = height, поэтому запас в пиксель
+        width = max([self.width + 1, 310] + [text.get_width() for _, _, text in recipes])
+        height = recipe_top + 25 * (len(recipes) + 1)
+        panel = pygame.Surface((width, height), pygame.SRCALPHA)
+        
+        pygame.draw.rect(panel, DARK_GRAY, (0, 0, self.width, self.height))
+        pygame.draw.rect(panel, LIGHT_GRAY, (0, 0, self.width, self.height), 2)
+        for i in range(INVENTORY_WIDTH + 1):
+            pygame.draw.line(panel, LIGHT_GRAY, (i * self.cell_size, 0), (i * self.cell_size, self.height), 1)
+        for i in range(INVENTORY_HEIGHT + 1):
+            pygame.draw.line(panel, LIGHT_GRAY, (0, i * self.cell_size), (self.width, i * self.cell_size), 1)
+        
+        self.item_cells = []
+        for idx, (item_type, count) in enumerate(inventory.items()):
+            row = idx // INVENTORY_WIDTH
+            col = idx % INVENTORY_WIDTH
+            if count <= 0 or row >= INVENTORY_HEIGHT:
+                continue
+            cell_x = col * self.cell_size + 5
+            cell_y = row * self.cell_size + 5
+            color = RESOURCE_COLORS.get(item_type, WHITE)
+            
+            if item_type == 'sword':
+                pygame.draw.line(panel, color, 
+                               (cell_x, cell_y + self.cell_size - 10),
+                               (cell_x + self.cell_size - 10, cell_y + 10), 3)
+            elif item_type == 'potion':
+                # Рисуем зелье в инвентаре
+                pygame.draw.rect(panel, color, (cell_x + 10, cell_y + 5, self.cell_size - 20, self.cell_size - 10))
+                pygame.draw.rect(panel, DARK_GRAY, (cell_x + self.cell_size//2 - 2, cell_y, 4, 5))
+            else:
+                pygame.draw.rect(panel, color, (cell_x, cell_y, self.cell_size - 10, self.cell_size - 10))
+            
+            count_text = text_cache.render(str(count), 16, WHITE)
+            panel.blit(count_text, (cell_x + self.cell_size - 25, cell_y + self.cell_size - 20))
+            self.item_cells.append(pygame.Rect(self.x + col * self.cell_size, self.y + row * self.cell_size,
+                                               self.cell_size, self.cell_size))
+        
+        panel.blit(text_cache.render("Рецепты крафта:", 20, WHITE), (0, recipe_top))
+        # Кнопки: "Скрафтить" - один предмет, "xN" - сразу столько, на сколько хватает ингредиентов
+        self.craft_buttons = []
+        for i, (recipe, times, text) in enumerate(recipes):
+            recipe_y = recipe_top + 25 * (i + 1)
+            panel.blit(text, (0, recipe_y))
+            if times:
+                pygame.draw.rect(panel, BLUE, (200, recipe_y, 60, 20))
+                panel.blit(text_cache.render("Скрафтить", 14, WHITE), (205, recipe_y + 2))
+                self.craft_buttons.append((pygame.Rect(self.x + 200, self.y + recipe_y, 60, 20), recipe, 1))
+                pygame.draw.rect(panel, BLUE, (265, recipe_y, 45, 20))
+                panel.blit(text_cache.render(f"x{times}", 14, WHITE), (270, recipe_y + 2))
+                self.craft_buttons.append((pygame.Rect(self.x + 265, self.y + recipe_y, 45, 20), recipe, None))
+        
+        self.panel = panel.convert_alpha() if pygame.display.get_surface() else panel
+        self.panel_version = inventory.version
+        
     def draw(self, screen):
         if not self.visible:
             return
-            
-        pygame.draw.rect(screen, DARK_GRAY, (self.x, self.y, self.width, self.height))
-        pygame.draw.rect(screen, LIGHT_GRAY, (self.x, self.y, self.width, self.height), 2)
+        if self.panel is None or self.panel_version != self.player.inventory.version:
+            self.build_panel()
+        screen.blit(self.panel, (self.x, self.y))
         
-        for i in range(INVENTORY_WIDTH + 1):
-            pygame.draw.line(screen, LIGHT_GRAY, 
-                           (self.x + i * self.cell_size, self.y),
-                           (self.x + i * self.cell_size, self.y + self.height), 1)
-        for i in range(INVENTORY_HEIGHT + 1):
-            pygame.draw.line(screen, LIGHT_GRAY, 
-                           (self.x, self.y + i * self.cell_size),
-                           (self.x + self.width, self.y + i * self.cell_size), 1)
-        
-        items = list(self.player.inventory.items())
-        for idx, (item_type, count) in enumerate(items):
-            if count > 0:
-                row = idx // INVENTORY_WIDTH
-                col = idx % INVENTORY_WIDTH
-                
-                if row < INVENTORY_HEIGHT:
-                    cell_x = self.x + col * self.cell_size + 5
-                    cell_y = self.y + row * self.cell_size + 5
-                    
-                    colors = {
-                        'stick': BROWN,
-                        'stone': GRAY,
-                        'berry': RED,
-                        'herb': GREEN,
-                        'sword': PURPLE,
-                        'potion': LIGHT_BLUE
-                    }
-                    
-                    color = colors.get(item_type, WHITE)
-                    
-                    if item_type == 'sword':
-                        pygame.draw.line(screen, color, 
-                                       (cell_x, cell_y + self.cell_size - 10),
-                                       (cell_x + self.cell_size - 10, cell_y + 10), 3)
-                    elif item_type == 'potion':
-                        # Рисуем зелье в инвентаре
-                        pygame.draw.rect(screen, color, (cell_x + 10, cell_y + 5, self.cell_size - 20, self.cell_size - 10))
-                        pygame.draw.rect(screen, DARK_GRAY, (cell_x + self.cell_size//2 - 2, cell_y, 4, 5))
-                    else:
-                        pygame.draw.rect(screen, color, (cell_x, cell_y, self.cell_size - 10, self.cell_size - 10))
-                    
-                    count_text = pygame.font.SysFont('arial', 16).render(str(count), True, WHITE)
-                    screen.blit(count_text, (cell_x + self.cell_size - 25, cell_y + self.cell_size - 20))
-        
-        recipe_y = self.y + self.height + 10
-        recipe_text = pygame.font.SysFont('arial', 20).render("Рецепты крафта:", True, WHITE)
-        screen.blit(recipe_text, (self.x, recipe_y))
-        
-        for recipe, ingredients in self.crafting_recipes.items():
-            recipe_y += 25
-            ingredient_text = f"{recipe}: "
-            for item, count in ingredients.items():
-                ingredient_text += f"{item} x{count} "
-            
-            can_craft = True
-            for item, count in ingredients.items():
-                if self.player.inventory.get(item, 0) < count:
-                    can_craft = False
-                    break
-            
-            color = GREEN if can_craft else RED
-            text = pygame.font.SysFont('arial', 16).render(ingredient_text, True, color)
-            screen.blit(text, (self.x, recipe_y))
-            
-            if can_craft:
-                craft_rect = pygame.Rect(self.x + 200, recipe_y, 60, 20)
-                pygame.draw.rect(screen, BLUE, craft_rect)
-                craft_text = pygame.font.SysFont('arial', 14).render("Скрафтить", True, WHITE)
-                screen.blit(craft_text, (craft_rect.x + 5, craft_rect.y + 2))
+        # Подсветка под курсором рисуется поверх готовой панели и ее не портит
+        mouse_pos = pygame.mouse.get_pos()
+        for cell in self.item_cells:
+            if cell.collidepoint(mouse_pos):
+                pygame.draw.rect(screen, YELLOW, cell, 2)
+        for rect, _, _ in self.craft_buttons:
+            if rect.collidepoint(mouse_pos):
+                pygame.draw.rect(screen, WHITE, rect, 1)
                 
-                mouse_pos = pygame.mouse.get_pos()
-                if craft_rect.collidepoint(mouse_pos) and pygame.mouse.get_pressed()[0]:
-                    self.craft_item(recipe, ingredients)
-    
-    def craft_item(self, item, ingredients):
-        for ingredient, count in ingredients.items():
-            if self.player.inventory.get(ingredient, 0) < count:
-                return False
-        
-        for ingredient, count in ingredients.items():
-            self.player.inventory[ingredient] -= count
-        
-        self.player.inventory[item] = self.player.inventory.get(item, 0) + 1
-        return True
+    def button_at(self, pos):
+        # (рецепт, сколько раз) для кнопки крафта под pos; крафтит сама игра по событию нажатия
+        if not self.visible:
+            return None
+        for rect, recipe, times in self.craft_buttons:
+            if rect.collidepoint(pos):
+                return recipe, times
+        return None
 
 class MiniMap:
-    def __init__(self):
+    def __init__(self, refresh_ms=MINIMAP_REFRESH_MS):
         self.width = 200
         self.height = 150
         self.x = SCREEN_WIDTH - self.width - 10
         self.y = 10
         self.border = 2
+        self.scale_x = self.width / WORLD_WIDTH
+        self.scale_y = self.height / WORLD_HEIGHT
+        
+        # Фон, рамка, деревья и ресурсы меняются редко - они рисуются в статичный слой
+        # один раз и дальше правятся точечно; метки игрока и врагов обновляются раз в refresh_ms
+        self.static_layer = None
+        self.refresh_ms = refresh_ms
+        self.marker_pad = 4
+        self.marker_layer = pygame.Surface((self.width + self.marker_pad * 2, self.height + self.marker_pad * 2),
+                                           pygame.SRCALPHA)
+        self.last_marker_update = None
+        
+    def map_pos(self, x, y):
+        return int(x * self.scale_x), int(y * self.scale_y)
+    
+    def draw_dot(self, x, y, color):
+        pygame.draw.circle(self.static_layer, color, self.map_pos(x, y), 1)
+        
+    def draw_border(self):
+        pygame.draw.rect(self.static_layer, LIGHT_GRAY, (0, 0, self.width, self.height), self.border)
+        
+    def build_static_layer(self, trees, resources):
+        self.static_layer = pygame.Surface((self.width, self.height))
+        self.static_layer.fill(DARK_GRAY)
+        for tree in trees:
+            self.draw_dot(tree.x, tree.y, DARK_GREEN)
+        for resource in resources:
+            self.draw_dot(resource.x, resource.y, RESOURCE_COLORS[resource.type])
+        self.draw_border()
+        
+    def add_dot(self, x, y, color):
+        if self.static_layer is not None:
+            self.draw_dot(x, y, color)
+            self.draw_border()
+            
+    def erase_dot(self, x, y, neighbours):
+        # Точка занимает 3x3 пикселя: стираем ее и дорисовываем соседей (x, y, цвет), которые могли задеть это место
+        if self.static_layer is None:
+            return
+        map_x, map_y = self.map_pos(x, y)
+        self.static_layer.fill(DARK_GRAY, (map_x - 1, map_y - 1, 3, 3))
+        for neighbour in neighbours:
+            self.draw_dot(*neighbour)
+        self.draw_border()
+        
+    def update_markers(self, player, enemies):
+        pad = self.marker_pad
+        self.marker_layer.fill((0, 0, 0, 0))
+        
+        n = enemies.count
+        enemy_map_x = (pad + (enemies.x[:n] * self.scale_x).astype(np.int64)).tolist()
+        enemy_map_y = (pad + (enemies.y[:n] * self.scale_y).astype(np.int64)).tolist()
+        type_colors = [ENEMY_TYPES[name]['color'] for name in ENEMY_TYPE_NAMES]
+        for map_x, map_y, type_id in zip(enemy_map_x, enemy_map_y, enemies.type_id[:n].tolist()):
+            pygame.draw.circle(self.marker_layer, type_colors[type_id], (map_x, map_y), 3)
+            
+        player_map_x, player_map_y = self.map_pos(player.x, player.y)
+        pygame.draw.circle(self.marker_layer, ORANGE, (pad + player_map_x, pad + player_map_y), 4)
         
-    def draw(self, screen, player, enemies, trees):
-        pygame.draw.rect(screen, DARK_GRAY, (self.x, self.y, self.width, self.height))
-        pygame.draw.rect(screen, LIGHT_GRAY, (self.x, self.y, self.width, self.height), self.border)
-        
-        scale_x = self.width / WORLD_WIDTH
-        scale_y = self.height / WORLD_HEIGHT
-        
-        player_map_x = self.x + int(player.x * scale_x)
-        player_map_y = self.y + int(player.y * scale_y)
-        
-        pygame.draw.circle(screen, ORANGE, (player_map_x, player_map_y), 4)
-        
-        for enemy in enemies:
-            enemy_map_x = self.x + int(enemy.x * scale_x)
-            enemy_map_y = self.y + int(enemy.y * scale_y)
-            pygame.draw.circle(screen, enemy.color, (enemy_map_x, enemy_map_y), 3)
+    def draw(self, screen, player, enemies):
+        screen.blit(self.static_layer, (self.x, self.y))
         
-        for tree in trees[:50]:
-            tree_map_x = self.x + int(tree.x * scale_x)
-            tree_map_y = self.y + int(tree.y * scale_y)
-            pygame.draw.circle(screen, DARK_GREEN, (tree_map_x, tree_map_y), 1)
+        current_time = pygame.time.get_ticks()
+        if self.last_marker_update is None or current_time - self.last_marker_update >= self.refresh_ms:
+            self.update_markers(player, enemies)
+            self.last_marker_update = current_time
+        screen.blit(self.marker_layer, (self.x - self.marker_pad, self.y - self.marker_pad))
         
-        map_text = pygame.font.SysFont('arial', 12).render("Карта", True, WHITE)
+        map_text = text_cache.render("Карта", 12, WHITE)
         screen.blit(map_text, (self.x + self.width//2 - map_text.get_width()//2, self.y + self.height + 2))
 
 class WaveManager:
-    def __init__(self):
+    def __init__(self, clock):
+        self.clock = clock
         self.current_wave = 0
         self.waves = [
             {"enemies_to_kill": 15, "description": "Волна 1: Убейте 15 врагов"},
@@ -425,29 +1986,33 @@ class WaveManager:
         self.game_start_time = 0
         self.victory_time = 0
         
+    def get_time(self):
+        # Секунды времени симуляции: пауза и инвентарь волны не подгоняют
+        return self.clock.now() / 1000
+        
     def start_next_wave(self):
         if self.current_wave < len(self.waves):
             self.current_wave += 1
             self.enemies_killed_this_wave = 0
             self.state = "active"
-            self.wave_start_time = time.time()
+            self.wave_start_time = self.get_time()
             return True
         return False
     
     def end_wave(self):
         self.state = "between_waves"
-        self.wave_end_time = time.time()
+        self.wave_end_time = self.get_time()
     
     def check_victory(self):
         if self.current_wave == len(self.waves) and self.enemies_killed_this_wave >= self.waves[-1]["enemies_to_kill"]:
             self.state = "victory"
-            self.victory_time = time.time()
+            self.victory_time = self.get_time()
             return True
         return False
     
     def get_remaining_rest_time(self):
         if self.state == "between_waves":
-            elapsed = time.time() - self.wave_end_time
+            elapsed = self.get_time() - self.wave_end_time
             remaining = max(0, self.rest_time - elapsed)
             return remaining
         return 0
@@ -463,19 +2028,668 @@ class WaveManager:
     def get_total_game_time(self):
         if self.state == "victory":
             return self.victory_time - self.game_start_time
-        return time.time() - self.game_start_time
+        return self.get_time() - self.game_start_time
 
-class Game:
+class WorldGenerator:
+    # Содержимое чанка зависит только от (seed, chunk_x, chunk_y), поэтому любой чанк
+    # можно выбросить и потом сгенерировать заново точно таким же
+    def __init__(self, seed):
+        self.seed = seed
+        
+    def has_chunk(self, chunk_x, chunk_y):
+        return (0 <= chunk_x * CHUNK_SIZE <= WORLD_WIDTH - TILE_SIZE and
+                0 <= chunk_y * CHUNK_SIZE <= WORLD_HEIGHT - TILE_SIZE)
+    
+    def generate_chunk(self, chunk_x, chunk_y):
+        # Вызывается из фонового потока: только чистые данные, никаких объектов игры и pygame
+        rng = random.Random(f"{self.seed}:{chunk_x}:{chunk_y}")
+        min_x = chunk_x * CHUNK_SIZE
+        min_y = chunk_y * CHUNK_SIZE
+        max_x = min(min_x + CHUNK_SIZE, WORLD_WIDTH - TILE_SIZE + 1)
+        max_y = min(min_y + CHUNK_SIZE, WORLD_HEIGHT - TILE_SIZE + 1)
+        
+        trees = []
+        for _ in range(rng.randint(2, 6)):
+            trees.append((rng.randrange(min_x, max_x), rng.randrange(min_y, max_y)))
+            
+        resources = []
+        for _ in range(rng.randint(1, 5)):
+            res_type = rng.choice(['stick', 'stone', 'berry', 'herb'])
+            resources.append((rng.randrange(min_x, max_x), rng.randrange(min_y, max_y), res_type))
+        return trees, resources
+
+world_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="world-gen")
+
+class ChunkStreamer:
+    # Чанки в радиусе загрузки нужны прямо сейчас, следующее кольцо заранее генерируется в фоне,
+    # а все, что дальше радиуса хранения, выгружается. От выгруженного чанка остаются только
+    # номера собранных ресурсов, поэтому память не растет, сколько бы игрок ни шел
+    def __init__(self, generator, load_radius=WORLD_LOAD_RADIUS, prefetch_radius=WORLD_PREFETCH_RADIUS,
+                 keep_radius=WORLD_KEEP_RADIUS, executor=None):
+        self.generator = generator
+        self.load_radius = load_radius
+        self.prefetch_radius = prefetch_radius
+        self.keep_radius = keep_radius
+        self.executor = executor or world_executor
+        self.loaded = {}
+        self.pending = {}
+        self.harvested = {}
+        self.center = None
+        self.generated = 0
+        self.evicted = 0
+        self.waited = 0
+        
+    def chunk_of(self, x, y):
+        return int(x // CHUNK_SIZE), int(y // CHUNK_SIZE)
+    
+    def chunks_around(self, center, radius):
+        center_x, center_y = center
+        keys = []
+        for chunk_y in range(center_y - radius, center_y + radius + 1):
+            for chunk_x in range(center_x - radius, center_x + radius + 1):
+                if self.generator.has_chunk(chunk_x, chunk_y):
+                    keys.append((chunk_x, chunk_y))
+        return keys
+    
+    def distance(self, key):
+        return max(abs(key[0] - self.center[0]), abs(key[1] - self.center[1]))
+    
+    def update(self, x, y):
+        # Возвращает готовые к добавлению чанки и ключи чанков, которые надо выгрузить.
+        # Что попадает в мир, зависит только от позиции, а не от скорости фонового потока:
+        # если нужный чанк еще не готов, ждем его
+        center = self.chunk_of(x, y)
+        if center == self.center:
+            return [], []
+        self.center = center
+        
+        for key in self.chunks_around(center, self.prefetch_radius):
+            if key not in self.loaded and key not in self.pending:
+                self.pending[key] = self.executor.submit(self.generator.generate_chunk, *key)
+                self.generated += 1
+                
+        ready = []
+        for key in self.chunks_around(center, self.load_radius):
+            if key in self.loaded:
+                continue
+            future = self.pending.pop(key)
+            if not future.done():
+                self.waited += 1
+            ready.append((key, future.result()))
+            
+        for key in [key for key in self.pending if self.distance(key) > self.keep_radius]:
+            self.pending.pop(key).cancel()
+        evicted = sorted(key for key in self.loaded if self.distance(key) > self.keep_radius)
+        return ready, evicted
+    
+    def restore(self, keys):
+        # Чанки из сохранения генерируются сразу: мир после загрузки тот же, что был при записи
+        return [(key, self.generator.generate_chunk(*key)) for key in keys if key not in self.loaded]
+    
+    def mark_loaded(self, key, trees, resources):
+        self.loaded[key] = (trees, resources)
+        
+    def evict(self, key):
+        self.evicted += 1
+        return self.loaded.pop(key)
+    
+    def record_harvest(self, resource):
+        if resource.origin is None:
+            return
+        key, index = resource.origin
+        self.harvested.setdefault(key, set()).add(index)
+        if key in self.loaded:
+            self.loaded[key][1].remove(resource)
+            
+    def get_stats(self):
+        return {
+            'loaded': len(self.loaded),
+            'pending': len(self.pending),
+            'harvested': sum(len(indices) for indices in self.harvested.values()),
+            'generated': self.generated,
+            'evicted': self.evicted,
+            'waited': self.waited,
+        }
+
+class SaveWriter:
     def __init__(self):
-        self.texture_manager = TextureManager()
+        self.parts = []
+        
+    def pack(self, fmt, *values):
+        self.parts.append(struct.pack('<' + fmt, *values))
+        
+    def string(self, value):
+        data = value.encode('utf-8')
+        self.pack('B', len(data))
+        self.parts.append(data)
+        
+    def array(self, values, dtype):
+        self.parts.append(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        
+    def getvalue(self):
+        return b''.join(self.parts)
+
+class SaveReader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+        
+    def unpack(self, fmt):
+        fmt = '<' + fmt
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+    
+    def string(self):
+        length, = self.unpack('B')
+        value = bytes(self.data[self.offset:self.offset + length]).decode('utf-8')
+        self.offset += length
+        return value
+    
+    def array(self, count, dtype):
+        values = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.offset).copy()
+        self.offset += values.nbytes
+        return values
+
+class SaveFile:
+    # Двоичный формат: заголовок с версией, затем скаляры через struct и массивы врагов
+    # и собранных ресурсов одним куском байт. Мир не сохраняется - он восстанавливается из seed
+    # по списку чанков, загруженных в момент сохранения
+    MAGIC = b'GTSV'
+    VERSION = 2
+    
+    @staticmethod
+    def serialize(snapshot):
+        out = SaveWriter()
+        out.pack('4sHq', SaveFile.MAGIC, SaveFile.VERSION, snapshot['world_seed'])
+        out.string(snapshot['game_state'])
+        out.pack('dq', *snapshot['sim'])
+        
+        out.pack('7d', *snapshot['player'])
+        out.string(snapshot['equipped'] or '')
+        out.pack('H', len(snapshot['inventory']))
+        for name, count in snapshot['inventory'].items():
+            out.string(name)
+            out.pack('i', count)
+            
+        current_wave, enemies_killed, killed_this_wave, wave_state, *wave_times = snapshot['wave']
+        out.pack('3q', current_wave, enemies_killed, killed_this_wave)
+        out.string(wave_state)
+        out.pack('4d', *wave_times)
+        out.pack('3d', *snapshot['timers'])
+        
+        enemies = snapshot['enemies']
+        out.pack('I', len(enemies['x']))
+        for name in EnemyPool.SAVE_FIELDS:
+            out.array(enemies[name], enemies[name].dtype)
+            
+        out.pack('I', len(snapshot['harvested']))
+        out.array(snapshot['harvested'], np.int32)
+        
+        out.pack('I', len(snapshot['chunks']))
+        out.array(snapshot['chunks'], np.int32)
+        
+        extra = snapshot['extra_resources']
+        out.pack('I', len(extra))
+        out.array([(x, y) for x, y, _ in extra], np.float64)
+        out.array([RESOURCE_TYPE_NAMES.index(res_type) for _, _, res_type in extra], np.uint8)
+        return out.getvalue()
+    
+    @staticmethod
+    def deserialize(data):
+        reader = SaveReader(data)
+        magic, version, world_seed = reader.unpack('4sHq')
+        if magic != SaveFile.MAGIC:
+            raise ValueError("Это не файл сохранения")
+        if version != SaveFile.VERSION:
+            raise ValueError(f"Неподдерживаемая версия сохранения: {version}")
+        
+        snapshot = {'world_seed': world_seed, 'game_state': reader.string(), 'sim': reader.unpack('dq')}
+        snapshot['player'] = reader.unpack('7d')
+        snapshot['equipped'] = reader.string() or None
+        inventory = {}
+        for _ in range(reader.unpack('H')[0]):
+            name = reader.string()
+            inventory[name] = reader.unpack('i')[0]
+        snapshot['inventory'] = inventory
+        
+        wave_counters = reader.unpack('3q')
+        wave_state = reader.string()
+        snapshot['wave'] = wave_counters + (wave_state,) + reader.unpack('4d')
+        snapshot['timers'] = reader.unpack('3d')
+        
+        count, = reader.unpack('I')
+        snapshot['enemies'] = {name: reader.array(count, np.float64) for name in EnemyPool.FLOAT_FIELDS}
+        snapshot['enemies']['type_id'] = reader.array(count, np.int64)
+        snapshot['enemies']['last_step'] = reader.array(count, np.int64)
+        
+        count, = reader.unpack('I')
+        snapshot['harvested'] = reader.array(count * 3, np.int32).reshape(count, 3).tolist()
+        
+        count, = reader.unpack('I')
+        snapshot['chunks'] = [tuple(key) for key in reader.array(count * 2, np.int32).reshape(count, 2).tolist()]
+        
+        count, = reader.unpack('I')
+        positions = reader.array(count * 2, np.float64).reshape(count, 2).tolist()
+        types = reader.array(count, np.uint8).tolist()
+        snapshot['extra_resources'] = [(x, y, RESOURCE_TYPE_NAMES[type_id]) for (x, y), type_id in zip(positions, types)]
+        return snapshot
+    
+    @staticmethod
+    def write(path, snapshot):
+        # Сначала во временный файл с fsync, потом атомарная замена: оборванная запись не портит сохранение
+        data = SaveFile.serialize(snapshot)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        return len(data)
+    
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as f:
+            return SaveFile.deserialize(f.read())
+
+class AutosaveWorker:
+    # Главный поток только отдает снимок состояния, упаковка и запись на диск идут здесь.
+    # Если поток не успевает, промежуточные снимки пропускаются - пишется самый свежий
+    def __init__(self, path=SAVE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = None
+        self.running = True
+        self.saved = 0
+        self.last_error = None
+        self.thread = threading.Thread(target=self.run, name="autosave", daemon=True)
+        self.thread.start()
+        
+    def submit(self, snapshot):
+        with self.lock:
+            self.pending = snapshot
+        self.wakeup.set()
+        
+    def run(self):
+        while self.running or self.pending is not None:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                snapshot, self.pending = self.pending, None
+            if snapshot is None:
+                continue
+            try:
+                SaveFile.write(self.path, snapshot)
+                self.saved += 1
+            except (OSError, struct.error, ValueError) as e:
+                # Ошибка упаковки (слишком длинное имя, неизвестный тип ресурса) не должна убивать поток:
+                # файл на диске не тронут, следующий снимок запишется как обычно
+                self.last_error = e
+                print(f"Ошибка автосохранения: {e}")
+                
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+
+class DirtyRectRenderer:
+    # Для меню, паузы и финальных экранов: кадр перерисовывается только когда что-то поменялось,
+    # а на дисплей выводятся только измененные области
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.last_key = None
+        self.last_hover = None
+        self.presented_frames = 0
+        self.skipped_frames = 0
+        
+    def invalidate(self):
+        self.last_key = None
+        self.last_hover = None
+        
+    def get_dirty_rects(self, frame_key, hover_rect):
+        # None - кадр не изменился и рисовать ничего не нужно
+        if frame_key != self.last_key:
+            dirty = [screen.get_rect()]
+        elif hover_rect != self.last_hover:
+            dirty = [rect for rect in (self.last_hover, hover_rect) if rect is not None]
+        else:
+            self.skipped_frames += 1
+            return None
+        
+        self.last_key = frame_key
+        self.last_hover = hover_rect
+        self.presented_frames += 1
+        return dirty
+
+class TelemetryWriter:
+    # Главный поток только кладет кортеж в deque (append потокобезопасен и не блокирует),
+    # фоновый поток пачками превращает записи в JSONL и ротирует файл по размеру.
+    # Если диск не успевает, самые старые записи вытесняются из очереди, а кадр не ждет
+    def __init__(self, path, every=1, max_bytes=TELEMETRY_MAX_BYTES, backups=TELEMETRY_BACKUPS,
+                 flush_interval=0.5, max_queue=10000):
+        self.path = path
+        self.every = max(1, every)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.queue = deque(maxlen=max_queue)
+        self.frame = 0
+        self.dropped = 0
+        self.written = 0
+        self.running = True
+        self.file = open(path, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name="telemetry", daemon=True)
+        self.thread.start()
+        
+    def record(self, game):
+        self.frame += 1
+        if self.frame % self.every:
+            return
+        perf = game.perf
+        column = (perf.index - 1) % perf.history
+        waves = game.wave_manager
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append((
+            self.frame,
+            time.time(),
+            perf.frame_times[column],
+            game.sim_clock.now(),
+            perf.samples[:, column].tolist(),
+            len(game.enemy_pool),
+            len(game.resources),
+            len(game.trees),
+            waves.current_wave,
+            waves.state,
+            game.game_state,
+            [generation['collections'] for generation in gc.get_stats()],
+        ))
+        
+    def format(self, record):
+        (frame, wall_time, frame_ms, sim_ms, phases, enemies, resources, trees,
+         wave, wave_state, game_state, gc_collections) = record
+        return json.dumps({
+            'frame': frame,
+            'time': round(wall_time, 3),
+            'frame_ms': round(frame_ms, 3),
+            'sim_ms': round(sim_ms, 1),
+            'phases': {name: round(value, 3) for name, value in zip(PerfMonitor.PHASES, phases)},
+            'enemies': enemies,
+            'resources': resources,
+            'trees': trees,
+            'wave': wave,
+            'wave_state': wave_state,
+            'state': game_state,
+            'gc': gc_collections,
+        }, ensure_ascii=False)
+    
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, 'a', encoding='utf-8')
+        
+    def flush(self):
+        lines = []
+        while self.queue:
+            lines.append(self.format(self.queue.popleft()))
+        if not lines:
+            return
+        self.file.write('\n'.join(lines) + '\n')
+        self.file.flush()
+        self.written += len(lines)
+        if self.backups and self.file.tell() >= self.max_bytes:
+            self.rotate()
+            
+    def run(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Ошибка записи телеметрии: {e}")
+                
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+class PerfMonitor:
+    # Замеры фаз кадра пишутся в заранее выделенные кольцевые буферы: сбор можно не выключать.
+    # Сам оверлей перерисовывается раз в refresh_ms в свою поверхность, а каждый кадр только блитится
+    LOOP_PHASES = ('events', 'update', 'draw', 'tick')
+    DRAW_PHASES = ('terrain', 'resources', 'enemies', 'submit', 'player', 'ui', 'minimap', 'inventory')
+    PHASES = LOOP_PHASES + DRAW_PHASES
+    
+    def __init__(self, history=PERF_HISTORY, refresh_ms=PERF_HUD_REFRESH_MS):
+        self.history = history
+        self.refresh_ms = refresh_ms
+        self.phase_index = {name: i for i, name in enumerate(self.PHASES)}
+        self.samples = np.zeros((len(self.PHASES), history), dtype=np.float64)
+        self.frame_times = np.zeros(history, dtype=np.float64)
+        self.current = [0.0] * len(self.PHASES)
+        self.started = [0.0] * len(self.PHASES)
+        self.index = 0
+        self.filled = 0
+        self.frame_start = time.perf_counter()
+        
+        self.visible = False
+        self.width = 320
+        self.graph_height = 60
+        self.surface = None
+        self.last_refresh = None
+        
+    def start(self, phase):
+        self.started[self.phase_index[phase]] = time.perf_counter()
+        
+    def stop(self, phase):
+        i = self.phase_index[phase]
+        self.current[i] += time.perf_counter() - self.started[i]
+        
+    def add(self, phase, seconds):
+        # Для фаз из другого потока: время приходит уже измеренным
+        self.current[self.phase_index[phase]] += seconds
+        
+    def end_frame(self):
+        now = time.perf_counter()
+        column = self.index
+        self.frame_times[column] = (now - self.frame_start) * 1000
+        self.frame_start = now
+        current = self.current
+        for i in range(len(current)):
+            self.samples[i, column] = current[i] * 1000
+            current[i] = 0.0
+        self.index = (column + 1) % self.history
+        self.filled = min(self.filled + 1, self.history)
+        
+    def toggle(self):
+        self.visible = not self.visible
+        self.last_refresh = None
+        
+    def ordered_frame_times(self):
+        # Кольцо в хронологическом порядке, от старых кадров к новым
+        if self.filled < self.history:
+            return self.frame_times[:self.filled]
+        return np.roll(self.frame_times, -self.index)
+    
+    def render(self, game):
+        frame_times = self.ordered_frame_times()
+        lines = []
+        if frame_times.size:
+            p50, p99 = np.percentile(frame_times, (50, 99))
+            lines.append(f"кадр {frame_times[-1]:5.1f} мс  p50 {p50:5.1f}  p99 {p99:5.1f}")
+            means = self.samples[:, :self.filled].mean(axis=1)
+            for names in (self.LOOP_PHASES, self.DRAW_PHASES[:4], self.DRAW_PHASES[4:]):
+                lines.append("  ".join(f"{name} {means[self.phase_index[name]]:.2f}" for name in names))
+        pools = game.get_pool_stats()
+        for name, label in (('enemies', 'враги'), ('resources', 'ресурсы'), ('trees', 'деревья')):
+            stats = pools[name]
+            lines.append(f"{label} {stats['active']} из {stats['capacity']}  повторно {stats['reuse_rate']:.0%}")
+        chunks = pools['chunks']
+        lines.append(f"чанки {chunks['loaded']} (+{chunks['pending']} в фоне)  выгружено {chunks['evicted']}  "
+                     f"ждали {chunks['waited']}")
+        lines.append(f"на экране {game.draw_stats['drawn']} из {game.draw_stats['visited']}")
+        lines.append(f"кэш текста {text_cache.hit_rate():.0%}  чанки {game.terrain_cache.hit_rate():.0%}")
+        assets = game.texture_manager.assets
+        lines.append(f"текстуры из кэша {assets.hits} из {assets.hits + assets.misses}")
+        queue = game.render_queue
+        per_batch = queue.submitted / queue.batches if queue.batches else 0.0
+        lines.append(f"вызовов blits {queue.batches}, по {per_batch:.0f} спрайтов")
+        dirty = game.dirty_renderer
+        lines.append(f"статичные кадры: выведено {dirty.presented_frames}, пропущено {dirty.skipped_frames}")
+        lines.append(f"поле пересчитано {game.flow_field.recomputes}  касаний {game.collision.contacts}")
+        
+        line_height = 16
+        height = len(lines) * line_height + self.graph_height + 12
+        if self.surface is None or self.surface.get_height() != height:
+            self.surface = pygame.Surface((self.width, height), pygame.SRCALPHA)
+        self.surface.fill((0, 0, 0, 180))
+        for i, line in enumerate(lines):
+            self.surface.blit(text_cache.render(line, 14, WHITE), (6, 4 + i * line_height))
+            
+        # График: полная высота - два кадра по 60 FPS, линия - бюджет одного кадра
+        graph_top = height - self.graph_height - 4
+        budget = 1000 / FPS
+        scale = self.graph_height / (budget * 2)
+        pygame.draw.line(self.surface, YELLOW, (6, graph_top + self.graph_height - int(budget * scale)),
+                         (self.width - 6, graph_top + self.graph_height - int(budget * scale)))
+        if frame_times.size > 1:
+            step = (self.width - 12) / (self.history - 1)
+            points = [(6 + i * step, graph_top + self.graph_height - min(self.graph_height, value * scale))
+                      for i, value in enumerate(frame_times.tolist())]
+            pygame.draw.lines(self.surface, GREEN, False, points)
+            
+    def draw(self, screen, game):
+        current_time = pygame.time.get_ticks()
+        if self.last_refresh is None or current_time - self.last_refresh >= self.refresh_ms:
+            self.render(game)
+            self.last_refresh = current_time
+        # Над строкой про зелья в левом нижнем углу
+        screen.blit(self.surface, (10, SCREEN_HEIGHT - self.surface.get_height() - 35))
+
+class SimSnapshot:
+    # Все, что нужно кадру, копией на момент шага симуляции. После создания не меняется, поэтому
+    # отрисовка читает его без блокировок, пока поток симуляции считает следующий шаг
+    __slots__ = ('tick', 'published_at', 'game_state', 'inventory_visible', 'inventory_version', 'player',
+                 'enemies', 'resources', 'resources_visited', 'wave', 'damage_indicator', 'show_potion_effect')
+    
+    def __init__(self, game):
+        self.tick = game.sim_clock.ticks
+        self.published_at = time.perf_counter()
+        self.game_state = game.game_state
+        self.inventory_visible = game.inventory.visible
+        self.inventory_version = game.player.inventory.version
+        self.player = copy.copy(game.player)
+        self.player.inventory = dict(game.player.inventory.items())
+        self.enemies = EnemySnapshot(game.enemy_pool)
+        
+        # Камера кадра отстает от последнего шага меньше чем на шаг игрока, поэтому ресурсы
+        # берем вокруг нее с двойным запасом
+        camera = game.snapshot_camera
+        camera.update(game.player)
+        self.resources = tuple((resource.x, resource.y, resource.type)
+                               for resource in game.resource_grid.query_view(camera, VIEW_MARGIN * 2))
+        self.resources_visited = game.resource_grid.last_visited
+        
+        self.wave = copy.copy(game.wave_manager)
+        self.wave.clock = copy.copy(game.sim_clock)
+        self.damage_indicator = game.damage_indicator
+        self.show_potion_effect = game.show_potion_effect
+
+class SimulationWorker:
+    # Симуляция в своем потоке: шаги идут по SimClock от реального времени. Когда шаги, ввод или крафт
+    # что-то изменили, снимок кладется в свободный из двух слотов и становится текущим. Главный поток
+    # рисует текущий снимок, а в саму игру заходит только под sim_lock: события ввода и редкие чтения мира
+    def __init__(self, game):
+        self.game = game
+        self.slots = [SimSnapshot(game), None]
+        self.front = 0
+        self.published = 1
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="simulation", daemon=True)
+        self.thread.start()
+        
+    def latest(self):
+        return self.slots[self.front]
+    
+    def publish(self, snapshot):
+        back = 1 - self.front
+        self.slots[back] = snapshot
+        self.front = back
+        self.published += 1
+        
+    def changed(self, game):
+        view = self.latest()
+        return (game.sim_clock.ticks != view.tick or game.game_state != view.game_state or
+                game.inventory.visible != view.inventory_visible or
+                game.player.inventory.version != view.inventory_version)
+    
+    def run(self):
+        last = time.perf_counter()
+        while self.running:
+            now = time.perf_counter()
+            game = self.game
+            with game.sim_lock:
+                clock = game.sim_clock
+                steps = clock.advance((now - last) * 1000)
+                for _ in range(steps):
+                    game.update()
+                # В меню, на паузе и в инвентаре update ничего не делает - тот же снимок не переснимаем
+                if self.changed(game):
+                    self.publish(SimSnapshot(game))
+                wait_ms = clock.step_ms - clock.accumulator
+            last = now
+            if steps:
+                game.perf.add('update', time.perf_counter() - now)
+            time.sleep(max(wait_ms, 1) / 1000)
+            
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+class Game:
+    def __init__(self, input_source=None, headless=False, world_seed=None, sim_lock=None):
+        self.input_source = input_source or KeyboardInput()
+        self.headless = headless
+        # Держит поток симуляции на время шагов; главный поток берет ее для ввода и чтения мира
+        self.sim_lock = sim_lock or threading.RLock()
+        self.simulation = None
+        self.world_seed = world_seed if world_seed is not None else random.getrandbits(32)
+        self.texture_manager = TextureManager(load=not headless)
         self.camera = Camera()
+        self.snapshot_camera = Camera()
         self.player = Player(WORLD_WIDTH // 2, WORLD_HEIGHT // 2, self.texture_manager)
         self.inventory = Inventory(self.player)
         self.minimap = MiniMap()
-        self.wave_manager = WaveManager()
-        self.enemies = []
-        self.resources = []
-        self.trees = []
+        self.sim_clock = SimClock()
+        self.wave_manager = WaveManager(self.sim_clock)
+        self.resource_pool = ObjectPool(Resource)
+        self.tree_pool = ObjectPool(Tree)
+        self.resources = self.resource_pool.active
+        self.trees = self.tree_pool.active
+        self.enemy_grid = SpatialGrid()
+        self.enemy_pool = EnemyPool(self.enemy_grid)
+        self.flow_field = FlowField()
+        self.collision = CollisionSystem()
+        self.enemies = self.enemy_pool.handles
+        # Статичные объекты хранятся крупными чанками: по ним в основном идет отсечение при отрисовке
+        self.resource_grid = SpatialGrid(CHUNK_SIZE)
+        self.tree_grid = SpatialGrid(CHUNK_SIZE)
+        self.terrain_cache = TerrainCache(self.texture_manager, self.tree_grid, self.sim_lock)
+        # Кэши отрисовки принадлежат главному потоку: симуляция только ставит им задания в очередь
+        self.render_events = deque()
+        self.world_streamer = ChunkStreamer(WorldGenerator(self.world_seed))
+        self.autosave = None
+        self.last_autosave = 0
+        self.recorder = None
+        self.perf = PerfMonitor()
+        self.draw_stats = {'visited': 0, 'drawn': 0}
+        self.dirty_renderer = DirtyRectRenderer()
+        self.render_queue = RenderQueue()
         self.game_state = "menu"
         self.menu_state = "main"  # "main", "controls"
         self.last_enemy_spawn = 0
@@ -485,177 +2699,360 @@ class Game:
         self.damage_indicator_time = 0
         self.potion_effect_time = 0
         self.show_potion_effect = False
-        self.generate_world()
+        self.stream_world()
         
-    def generate_world(self):
-        for _ in range(100):
-            x = random.randint(0, WORLD_WIDTH - TILE_SIZE)
-            y = random.randint(0, WORLD_HEIGHT - TILE_SIZE)
-            self.trees.append(Tree(x, y))
+    def stream_world(self):
+        ready, evicted = self.world_streamer.update(self.player.x, self.player.y)
+        for key in evicted:
+            self.unload_chunk(key)
+                
+        for key, chunk in ready:
+            self.load_chunk(key, chunk)
             
-        for _ in range(80):
-            x = random.randint(0, WORLD_WIDTH - TILE_SIZE)
-            y = random.randint(0, WORLD_HEIGHT - TILE_SIZE)
-            res_type = random.choice(['stick', 'stone', 'berry', 'herb'])
-            self.resources.append(Resource(x, y, res_type))
+    def unload_chunk(self, key):
+        trees, resources = self.world_streamer.evict(key)
+        for tree in trees:
+            self.remove_tree(tree)
+        for resource in resources:
+            self.remove_resource(resource)
+            
+    def load_chunk(self, key, chunk):
+        tree_data, resource_data = chunk
+        harvested = self.world_streamer.harvested.get(key, ())
+        trees = [self.add_tree(x, y) for x, y in tree_data]
+        resources = [self.add_resource(x, y, res_type, (key, index))
+                     for index, (x, y, res_type) in enumerate(resource_data) if index not in harvested]
+        self.world_streamer.mark_loaded(key, trees, resources)
+    
+    def add_tree(self, x, y):
+        tree = self.tree_pool.acquire(x, y)
+        self.tree_grid.insert(tree)
+        self.queue_render(self.terrain_cache.invalidate, tree.x, tree.y, tree.width, tree.height)
+        self.queue_render(self.minimap.add_dot, tree.x, tree.y, DARK_GREEN)
+        self.flow_field.block(*self.collision.inflated_box(tree))
+        self.collision.add_tree(tree)
+        return tree
+    
+    def remove_tree(self, tree):
+        self.tree_grid.remove(tree)
+        self.tree_pool.release(tree)
+        self.queue_render(self.terrain_cache.invalidate, tree.x, tree.y, tree.width, tree.height)
+        self.queue_render(self.minimap.erase_dot, tree.x, tree.y, self.get_minimap_neighbours(tree))
+        self.flow_field.unblock(*self.collision.inflated_box(tree))
+        self.collision.remove_tree(tree)
+    
+    def add_resource(self, x, y, res_type, origin=None):
+        resource = self.resource_pool.acquire(x, y, res_type, origin)
+        self.resource_grid.insert(resource)
+        self.queue_render(self.minimap.add_dot, resource.x, resource.y, RESOURCE_COLORS[resource.type])
+        return resource
+    
+    def remove_resource(self, resource):
+        self.resource_grid.remove(resource)
+        self.resource_pool.release(resource)
+        self.queue_render(self.minimap.erase_dot, resource.x, resource.y, self.get_minimap_neighbours(resource))
+        
+    def harvest_resource(self, resource):
+        self.world_streamer.record_harvest(resource)
+        self.remove_resource(resource)
+        
+    def get_minimap_neighbours(self, entity):
+        # Точки (x, y, цвет) всех, чья метка на миникарте может перекрываться с меткой entity
+        if self.minimap.static_layer is None:
+            return []
+        reach_x = 3 / self.minimap.scale_x
+        reach_y = 3 / self.minimap.scale_y
+        area = (entity.x - reach_x, entity.y - reach_y, reach_x * 2, reach_y * 2)
+        return ([(tree.x, tree.y, DARK_GREEN) for tree in self.tree_grid.query_rect(*area) if tree is not entity]
+                + [(resource.x, resource.y, RESOURCE_COLORS[resource.type])
+                   for resource in self.resource_grid.query_rect(*area) if resource is not entity])
+    
+    def queue_render(self, func, *args):
+        # Без окна кэшей отрисовки нет, копить для них задания незачем
+        if not self.headless:
+            self.render_events.append((func, args))
+            
+    def apply_render_events(self):
+        while self.render_events:
+            func, args = self.render_events.popleft()
+            func(*args)
+    
+    def add_enemy(self, x, y, enemy_type):
+        return self.enemy_pool.spawn(x, y, enemy_type)
+    
+    def remove_enemy(self, enemy):
+        self.enemy_pool.remove(enemy)
+    
+    def get_pool_stats(self):
+        return {
+            'enemies': self.enemy_pool.get_stats(),
+            'resources': self.resource_pool.get_stats(),
+            'trees': self.tree_pool.get_stats(),
+            'chunks': self.world_streamer.get_stats(),
+        }
     
     def spawn_enemy(self):
+        min_x = max(int(self.player.x) - ENEMY_SPAWN_RANGE, 0)
+        min_y = max(int(self.player.y) - ENEMY_SPAWN_RANGE, 0)
+        max_x = min(int(self.player.x) + ENEMY_SPAWN_RANGE, WORLD_WIDTH - TILE_SIZE)
+        max_y = min(int(self.player.y) + ENEMY_SPAWN_RANGE, WORLD_HEIGHT - TILE_SIZE)
         while True:
-            x = random.randint(0, WORLD_WIDTH - TILE_SIZE)
-            y = random.randint(0, WORLD_HEIGHT - TILE_SIZE)
+            x = random.randint(min_x, max_x)
+            y = random.randint(min_y, max_y)
             dist_to_player = math.sqrt((x - self.player.x)**2 + (y - self.player.y)**2)
             
             if dist_to_player > 300:
                 enemy_type = random.choice(['wolf', 'soldier'])
-                self.enemies.append(Enemy(x, y, enemy_type))
+                self.add_enemy(x, y, enemy_type)
                 break
     
+    def start_game(self):
+        self.game_state = "playing"
+        self.wave_manager.game_start_time = self.wave_manager.get_time()
+        self.wave_manager.start_next_wave()
+    
+    def restart(self, world_seed=None):
+        max_speed_steps = self.sim_clock.max_speed_steps
+        autosave = self.autosave
+        perf = self.perf
+        simulation = self.simulation
+        self.__init__(self.input_source, self.headless, world_seed, self.sim_lock)
+        self.sim_clock.max_speed_steps = max_speed_steps
+        self.autosave = autosave
+        self.perf = perf
+        self.simulation = simulation
+        
+    def snapshot(self):
+        # Только копии значений: дальше снимок может упаковываться в другом потоке
+        player = self.player
+        waves = self.wave_manager
+        harvested = [(key[0], key[1], index) for key, indices in self.world_streamer.harvested.items()
+                     for index in sorted(indices)]
+        extra_resources = [(resource.x, resource.y, resource.type) for resource in self.resources
+                           if resource.origin is None]
+        return {
+            'world_seed': self.world_seed,
+            'game_state': self.game_state,
+            'sim': (self.sim_clock.time_ms, self.sim_clock.ticks),
+            'player': (player.x, player.y, player.health, player.hunger, player.energy,
+                       player.direction, player.last_damage_time),
+            'equipped': player.equipped,
+            'inventory': dict(player.inventory.items()),
+            'wave': (waves.current_wave, waves.enemies_killed, waves.enemies_killed_this_wave, waves.state,
+                     waves.wave_start_time, waves.wave_end_time, waves.game_start_time, waves.victory_time),
+            'timers': (self.last_enemy_spawn, self.potion_effect_time, self.damage_indicator_time),
+            'enemies': self.enemy_pool.snapshot(),
+            'harvested': harvested,
+            'chunks': sorted(self.world_streamer.loaded),
+            'extra_resources': extra_resources,
+        }
+    
+    def save_game(self, path=SAVE_PATH):
+        if self.autosave:
+            self.autosave.submit(self.snapshot())
+        else:
+            SaveFile.write(path, self.snapshot())
+            
+    def load_game(self, path=SAVE_PATH):
+        snapshot = SaveFile.read(path)
+        self.restart(snapshot['world_seed'])
+        
+        # Мир заново строится из seed вокруг сохраненной позиции, без уже собранных ресурсов
+        for key in sorted(self.world_streamer.loaded):
+            self.unload_chunk(key)
+        for chunk_x, chunk_y, index in snapshot['harvested']:
+            self.world_streamer.harvested.setdefault((chunk_x, chunk_y), set()).add(index)
+        self.world_streamer.center = None
+        
+        player = self.player
+        (player.x, player.y, player.health, player.hunger, player.energy,
+         player.direction, player.last_damage_time) = snapshot['player']
+        player.prev_x, player.prev_y = player.x, player.y
+        player.equipped = snapshot['equipped']
+        player.inventory.replace(snapshot['inventory'])
+        for key, chunk in self.world_streamer.restore(snapshot['chunks']):
+            self.load_chunk(key, chunk)
+        self.stream_world()
+        for x, y, res_type in snapshot['extra_resources']:
+            self.add_resource(x, y, res_type)
+            
+        self.enemy_pool.restore(snapshot['enemies'])
+        self.sim_clock.time_ms, self.sim_clock.ticks = snapshot['sim']
+        player.last_step = self.sim_clock.ticks
+        waves = self.wave_manager
+        (waves.current_wave, waves.enemies_killed, waves.enemies_killed_this_wave, waves.state,
+         waves.wave_start_time, waves.wave_end_time, waves.game_start_time, waves.victory_time) = snapshot['wave']
+        self.last_enemy_spawn, self.potion_effect_time, self.damage_indicator_time = snapshot['timers']
+        self.last_autosave = self.sim_clock.now()
+        self.game_state = snapshot['game_state']
+    
+    def handle_key(self, key):
+        if (self.recorder is not None and key in InputRecording.KEYS and self.game_state == "playing"
+                and not self.inventory.visible):
+            self.recorder.record_key(self.sim_clock.ticks, key)
+            
+        if key == pygame.K_RETURN:
+            if self.game_state == "menu" and self.menu_state == "main":
+                self.start_game()
+            elif self.game_state == "victory":
+                self.restart()
+            
+        if key == pygame.K_ESCAPE:
+            if self.game_state == "playing":
+                if self.inventory.visible:
+                    self.inventory.visible = False
+                else:
+                    self.game_state = "paused"
+            elif self.game_state == "paused":
+                if self.show_warning:
+                    self.show_warning = False
+                else:
+                    self.game_state = "playing"
+            elif self.game_state == "menu" and self.menu_state == "controls":
+                self.menu_state = "main"
+            elif self.game_state == "menu":
+                return False
+                
+        if key == pygame.K_F3:
+            self.perf.toggle()
+            
+        if key == pygame.K_F5 and self.game_state in ("playing", "paused"):
+            self.save_game()
+            
+        if key == pygame.K_F9 and os.path.exists(SAVE_PATH):
+            try:
+                self.load_game()
+            except (OSError, ValueError, struct.error) as e:
+                print(f"Не удалось загрузить сохранение: {e}")
+            return True
+                
+        if key == pygame.K_i and self.game_state == "playing":
+            self.inventory.toggle()
+                
+        if key == pygame.K_e and self.game_state == "playing" and not self.inventory.visible:
+            for resource in self.resource_grid.query_radius(self.player.x, self.player.y, TILE_SIZE):
+                self.player.inventory.add(resource.type)
+                self.harvest_resource(resource)
+                    
+        if key == pygame.K_1 and self.game_state == "playing" and not self.inventory.visible:
+            if self.player.inventory.get('stick', 0) >= 1:
+                self.player.equipped = 'stick'
+            
+        if key == pygame.K_2 and self.game_state == "playing" and not self.inventory.visible:
+            if self.player.inventory.get('sword', 0) >= 1:
+                self.player.equipped = 'sword'
+            
+        if key == pygame.K_r and self.game_state == "playing" and not self.inventory.visible:
+            if self.player.inventory.remove('berry'):
+                self.player.hunger = min(100, self.player.hunger + 20)
+                
+        if key == pygame.K_h and self.game_state == "playing" and not self.inventory.visible:
+            if self.player.inventory.remove('herb'):
+                self.player.health = min(100, self.player.health + 15)
+                
+        if key == pygame.K_p and self.game_state == "playing" and not self.inventory.visible:
+            if self.player.use_potion():
+                self.show_potion_effect = True
+                self.potion_effect_time = self.sim_clock.now()
+                self.damage_indicator = "+40 HP"
+                self.damage_indicator_time = self.sim_clock.now()
+                
+        if key == pygame.K_SPACE and self.game_state == "playing" and not self.inventory.visible:
+            damage = 10
+            if self.player.equipped == 'sword':
+                damage = 25
+            
+            enemies_killed_this_attack = 0
+            for enemy in self.enemy_grid.query_radius(self.player.x, self.player.y, TILE_SIZE * 1.5):
+                enemy.health -= damage
+                if enemy.health <= 0:
+                    self.remove_enemy(enemy)
+                    self.wave_manager.enemies_killed += 1
+                    self.wave_manager.enemies_killed_this_wave += 1
+                    enemies_killed_this_attack += 1
+            
+            if enemies_killed_this_attack > 0:
+                self.damage_indicator = f"+{enemies_killed_this_attack}"
+                self.damage_indicator_time = self.sim_clock.now()
+                        
+        if key == pygame.K_RETURN and self.game_state == "game_over":
+            self.restart()
+        
+        return True
+    
+    def craft(self, recipe, times=1):
+        # В запись идет число реально скрафченных предметов: "максимум" при повторе не пересчитывается
+        crafted = self.inventory.crafting.craft(recipe, times)
+        if crafted and self.recorder is not None:
+            self.recorder.record_craft(self.sim_clock.ticks, recipe, crafted)
+        return crafted
+    
     def handle_events(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 return False
                 
             if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_RETURN:
-                    if self.game_state == "menu" and self.menu_state == "main":
-                        self.game_state = "playing"
-                        self.wave_manager.game_start_time = time.time()
-                        self.wave_manager.start_next_wave()
-                    elif self.game_state == "victory":
-                        self.__init__()
-                    
-                if event.key == pygame.K_ESCAPE:
-                    if self.game_state == "playing":
-                        if self.inventory.visible:
-                            self.inventory.visible = False
-                        else:
-                            self.game_state = "paused"
-                    elif self.game_state == "paused":
-                        if self.show_warning:
-                            self.show_warning = False
-                        else:
-                            self.game_state = "playing"
-                    elif self.game_state == "menu" and self.menu_state == "controls":
-                        self.menu_state = "main"
-                    elif self.game_state == "menu":
-                        return False
-                        
-                if event.key == pygame.K_i and self.game_state == "playing":
-                    self.inventory.toggle()
-                        
-                if event.key == pygame.K_e and self.game_state == "playing" and not self.inventory.visible:
-                    for resource in self.resources[:]:
-                        dist = math.sqrt((self.player.x - resource.x)**2 + (self.player.y - resource.y)**2)
-                        if dist < TILE_SIZE:
-                            self.player.inventory[resource.type] = self.player.inventory.get(resource.type, 0) + 1
-                            self.resources.remove(resource)
-                            
-                if event.key == pygame.K_1 and self.game_state == "playing" and not self.inventory.visible:
-                    if self.player.inventory.get('stick', 0) >= 1:
-                        self.player.equipped = 'stick'
-                    
-                if event.key == pygame.K_2 and self.game_state == "playing" and not self.inventory.visible:
-                    if self.player.inventory.get('sword', 0) >= 1:
-                        self.player.equipped = 'sword'
-                    
-                if event.key == pygame.K_r and self.game_state == "playing" and not self.inventory.visible:
-                    if self.player.inventory.get('berry', 0) > 0:
-                        self.player.hunger = min(100, self.player.hunger + 20)
-                        self.player.inventory['berry'] -= 1
-                        
-                if event.key == pygame.K_h and self.game_state == "playing" and not self.inventory.visible:
-                    if self.player.inventory.get('herb', 0) > 0:
-                        self.player.health = min(100, self.player.health + 15)
-                        self.player.inventory['herb'] -= 1
-                        
-                if event.key == pygame.K_p and self.game_state == "playing" and not self.inventory.visible:
-                    if self.player.use_potion():
-                        self.show_potion_effect = True
-                        self.potion_effect_time = pygame.time.get_ticks()
-                        self.damage_indicator = "+40 HP"
-                        self.damage_indicator_time = pygame.time.get_ticks()
-                        
-                if event.key == pygame.K_SPACE and self.game_state == "playing" and not self.inventory.visible:
-                    damage = 10
-                    if self.player.equipped == 'sword':
-                        damage = 25
-                    
-                    enemies_killed_this_attack = 0
-                    for enemy in self.enemies[:]:
-                        dist = math.sqrt((self.player.x - enemy.x)**2 + (self.player.y - enemy.y)**2)
-                        if dist < TILE_SIZE * 1.5:
-                            enemy.health -= damage
-                            if enemy.health <= 0:
-                                self.enemies.remove(enemy)
-                                self.wave_manager.enemies_killed += 1
-                                self.wave_manager.enemies_killed_this_wave += 1
-                                enemies_killed_this_attack += 1
-                    
-                    if enemies_killed_this_attack > 0:
-                        self.damage_indicator = f"+{enemies_killed_this_attack}"
-                        self.damage_indicator_time = pygame.time.get_ticks()
-                                
-                if event.key == pygame.K_RETURN and self.game_state == "game_over":
-                    self.__init__()
+                if not self.handle_key(event.key):
+                    return False
+            
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.game_state == "playing":
+                button = self.inventory.button_at(event.pos)
+                if button is not None:
+                    self.craft(*button)
             
             if event.type == pygame.MOUSEBUTTONDOWN and self.game_state == "menu":
                 mouse_pos = pygame.mouse.get_pos()
                 
                 if self.menu_state == "main":
-                    start_button = pygame.Rect(SCREEN_WIDTH//2 - 100, 300, 200, 50)
-                    controls_button = pygame.Rect(SCREEN_WIDTH//2 - 100, 370, 200, 50)
-                    
-                    if start_button.collidepoint(mouse_pos):
-                        self.game_state = "playing"
-                        self.wave_manager.game_start_time = time.time()
-                        self.wave_manager.start_next_wave()
+                    if START_BUTTON.collidepoint(mouse_pos):
+                        self.start_game()
                     
-                    if controls_button.collidepoint(mouse_pos):
+                    if CONTROLS_BUTTON.collidepoint(mouse_pos):
                         self.menu_state = "controls"
                 
                 elif self.menu_state == "controls":
-                    back_button = pygame.Rect(SCREEN_WIDTH//2 - 100, 600, 200, 50)
-                    if back_button.collidepoint(mouse_pos):
+                    if BACK_BUTTON.collidepoint(mouse_pos):
                         self.menu_state = "main"
             
             if event.type == pygame.MOUSEBUTTONDOWN and self.game_state == "paused" and self.show_warning:
                 mouse_pos = pygame.mouse.get_pos()
                 
-                yes_button = pygame.Rect(SCREEN_WIDTH//2 - 120, 450, 100, 40)
-                if yes_button.collidepoint(mouse_pos):
-                    self.__init__()
+                if YES_BUTTON.collidepoint(mouse_pos):
+                    self.restart()
                     self.game_state = "menu"
                     self.show_warning = False
                 
-                no_button = pygame.Rect(SCREEN_WIDTH//2 + 20, 450, 100, 40)
-                if no_button.collidepoint(mouse_pos):
+                if NO_BUTTON.collidepoint(mouse_pos):
                     self.show_warning = False
                     
+            elif event.type == pygame.MOUSEBUTTONDOWN and self.game_state == "paused":
+                if PAUSE_MENU_BUTTON.collidepoint(pygame.mouse.get_pos()):
+                    self.show_warning = True
+                    
+            if event.type == pygame.VIDEOEXPOSE:
+                self.dirty_renderer.invalidate()
+                    
         return True
     
     def update(self):
         if self.game_state != "playing" or self.inventory.visible:
             return
             
-        self.camera.update(self.player)
-            
-        keys = pygame.key.get_pressed()
-        dx, dy = 0, 0
+        self.sim_clock.tick()
         
-        if keys[pygame.K_w] or keys[pygame.K_UP]:
-            dy = -1
-        if keys[pygame.K_s] or keys[pygame.K_DOWN]:
-            dy = 1
-        if keys[pygame.K_a] or keys[pygame.K_LEFT]:
-            dx = -1
-        if keys[pygame.K_d] or keys[pygame.K_RIGHT]:
-            dx = 1
-            
+        dx, dy = self.input_source.get_movement()
+        if self.recorder is not None:
+            self.recorder.record_movement(dx, dy)
+        
+        self.player.prev_x = self.player.x
+        self.player.prev_y = self.player.y
+        self.player.last_step = self.sim_clock.ticks
         if dx != 0 or dy != 0:
-            self.player.move(dx, dy)
+            self.player.move(dx, dy, self.collision)
+            self.stream_world()
             
-        for enemy in self.enemies:
-            enemy.update(self.player)
+        self.enemy_pool.update(self.player, self.sim_clock, self.flow_field, self.collision)
         
         # Управление волнами
         if self.wave_manager.state == "active":
@@ -669,7 +3066,7 @@ class Game:
             
             # Спавн врагов во время активной волны
             if len(self.enemies) < 10:  # Максимум 10 врагов одновременно
-                current_time = pygame.time.get_ticks()
+                current_time = self.sim_clock.now()
                 if current_time - self.last_enemy_spawn > self.enemy_spawn_cooldown:
                     self.spawn_enemy()
                     self.last_enemy_spawn = current_time
@@ -685,80 +3082,157 @@ class Game:
         if self.player.hunger <= 0:
             self.player.health = max(0, self.player.health - 0.1)
             
-        if self.damage_indicator and pygame.time.get_ticks() - self.damage_indicator_time > 500:
+        if self.damage_indicator and self.sim_clock.now() - self.damage_indicator_time > 500:
             self.damage_indicator = None
             
-        if self.show_potion_effect and pygame.time.get_ticks() - self.potion_effect_time > 1000:
+        if self.show_potion_effect and self.sim_clock.now() - self.potion_effect_time > 1000:
             self.show_potion_effect = False
             
+        if self.autosave and self.sim_clock.now() - self.last_autosave >= AUTOSAVE_INTERVAL_MS:
+            self.autosave.submit(self.snapshot())
+            self.last_autosave = self.sim_clock.now()
+            
         if self.player.health <= 0:
             self.game_state = "game_over"
     
+    def get_static_frame_key(self, view):
+        # Все, от чего зависит картинка статичного экрана; None - идет игра и кадр меняется всегда.
+        # Мир на экране берется из снимка, поэтому и ключ строится по нему, а не по живой игре
+        if self.perf.visible:
+            return None
+        if view.game_state == "menu":
+            return ("menu", self.menu_state, view.tick)
+        if view.game_state == "paused":
+            rest_seconds = None
+            if view.wave.state == "between_waves":
+                rest_seconds = int(view.wave.get_remaining_rest_time())
+            return ("paused", self.show_warning, rest_seconds, view.tick)
+        if view.game_state in ("game_over", "victory"):
+            return (view.game_state, view.tick)
+        return None
+    
+    def get_hovered_button(self):
+        if self.game_state == "menu" and self.menu_state == "main":
+            buttons = [START_BUTTON, CONTROLS_BUTTON]
+        elif self.game_state == "menu" and self.menu_state == "controls":
+            buttons = [BACK_BUTTON]
+        elif self.game_state == "paused" and not self.show_warning:
+            buttons = [PAUSE_MENU_BUTTON]
+        else:
+            return None
+        
+        mouse_pos = pygame.mouse.get_pos()
+        for button in buttons:
+            if button.collidepoint(mouse_pos):
+                return button
+        return None
+    
     def draw(self):
+        view, alpha = self.capture()
+        frame_key = self.get_static_frame_key(view)
+        if self.dirty_renderer.enabled and frame_key is not None:
+            dirty_rects = self.dirty_renderer.get_dirty_rects(frame_key, self.get_hovered_button())
+            if dirty_rects is None:
+                return
+            self.draw_frame(view, alpha)
+            pygame.display.update(dirty_rects)
+        else:
+            self.dirty_renderer.invalidate()
+            self.draw_frame(view, alpha)
+            pygame.display.flip()
+    
+    def capture(self):
+        # Снимок для кадра и доля шага для интерполяции: с потоком симуляции - последний
+        # опубликованный, без него снимок делается прямо сейчас
+        if self.simulation is not None:
+            view = self.simulation.latest()
+            return view, min(1.0, (time.perf_counter() - view.published_at) * 1000 / self.sim_clock.step_ms)
+        return SimSnapshot(self), self.sim_clock.alpha()
+    
+    def draw_frame(self, view, alpha):
         screen.fill(BLACK)
         
-        if self.game_state == "menu":
+        if view.game_state == "playing" and not view.inventory_visible:
+            self.camera.alpha = alpha
+        else:
+            self.camera.alpha = 1.0
+        self.camera.sim_tick = view.tick
+        self.camera.update(view.player)
+        
+        if view.game_state == "menu":
             if self.menu_state == "main":
                 self.draw_main_menu()
             elif self.menu_state == "controls":
                 self.draw_controls_menu()
-        elif self.game_state == "playing":
-            self.draw_game()
-            self.inventory.draw(screen)
-            self.minimap.draw(screen, self.player, self.enemies, self.trees)
-            self.draw_wave_info()
-        elif self.game_state == "paused":
-            self.draw_game()
-            self.minimap.draw(screen, self.player, self.enemies, self.trees)
-            self.draw_wave_info()
+        elif view.game_state == "playing":
+            self.draw_game(view)
+            # Крафт в инвентаре меняет игрока, поэтому инвентарь рисуется по живым данным под блокировкой
+            self.perf.start('inventory')
+            with self.sim_lock:
+                self.inventory.draw(screen)
+            self.perf.stop('inventory')
+            self.draw_minimap(view)
+            self.draw_wave_info(view)
+        elif view.game_state == "paused":
+            self.draw_game(view)
+            self.draw_minimap(view)
+            self.draw_wave_info(view)
             if self.show_warning:
                 self.draw_warning()
             else:
                 self.draw_pause_menu()
-        elif self.game_state == "game_over":
-            self.draw_game()
-            self.minimap.draw(screen, self.player, self.enemies, self.trees)
+        elif view.game_state == "game_over":
+            self.draw_game(view)
+            self.draw_minimap(view)
             self.draw_game_over()
-        elif self.game_state == "victory":
-            self.draw_game()
-            self.minimap.draw(screen, self.player, self.enemies, self.trees)
-            self.draw_victory_screen()
+        elif view.game_state == "victory":
+            self.draw_game(view)
+            self.draw_minimap(view)
+            self.draw_victory_screen(view)
+            
+        if self.perf.visible:
+            with self.sim_lock:
+                self.perf.draw(screen, self)
             
-        pygame.display.flip()
+    def draw_minimap(self, view):
+        self.perf.start('minimap')
+        if self.minimap.static_layer is None:
+            # Слой строится по живому миру: задания, поставленные до этого момента, в нем уже учтены
+            with self.sim_lock:
+                self.apply_render_events()
+                self.minimap.build_static_layer(self.trees, self.resources)
+        self.minimap.draw(screen, view.player, view.enemies)
+        self.perf.stop('minimap')
     
     def draw_main_menu(self):
         screen.fill(GRASS_GREEN)
         
-        font_large = pygame.font.SysFont('arial', 60)
-        title = font_large.render("ЛЕСНОЙ БЕГЛЕЦ", True, WHITE)
+        title = text_cache.render("ЛЕСНОЙ БЕГЛЕЦ", 60, WHITE)
         screen.blit(title, (SCREEN_WIDTH//2 - title.get_width()//2, 150))
         
         # Кнопка "Начать игру"
-        start_button = pygame.Rect(SCREEN_WIDTH//2 - 100, 300, 200, 50)
-        pygame.draw.rect(screen, GREEN, start_button)
-        start_text = pygame.font.SysFont('arial', 30).render("Начать игру", True, WHITE)
-        screen.blit(start_text, (start_button.centerx - start_text.get_width()//2, 
-                               start_button.centery - start_text.get_height()//2))
+        pygame.draw.rect(screen, GREEN, START_BUTTON)
+        start_text = text_cache.render("Начать игру", 30, WHITE)
+        screen.blit(start_text, (START_BUTTON.centerx - start_text.get_width()//2, 
+                               START_BUTTON.centery - start_text.get_height()//2))
         
         # Кнопка "Управление"
-        controls_button = pygame.Rect(SCREEN_WIDTH//2 - 100, 370, 200, 50)
-        pygame.draw.rect(screen, BLUE, controls_button)
-        controls_text = pygame.font.SysFont('arial', 30).render("Управление", True, WHITE)
-        screen.blit(controls_text, (controls_button.centerx - controls_text.get_width()//2, 
-                                  controls_button.centery - controls_text.get_height()//2))
+        pygame.draw.rect(screen, BLUE, CONTROLS_BUTTON)
+        controls_text = text_cache.render("Управление", 30, WHITE)
+        screen.blit(controls_text, (CONTROLS_BUTTON.centerx - controls_text.get_width()//2, 
+                                  CONTROLS_BUTTON.centery - controls_text.get_height()//2))
         
         # Подсветка кнопок при наведении
         mouse_pos = pygame.mouse.get_pos()
-        if start_button.collidepoint(mouse_pos):
-            pygame.draw.rect(screen, (100, 255, 100), start_button, 3)
-        if controls_button.collidepoint(mouse_pos):
-            pygame.draw.rect(screen, (100, 100, 255), controls_button, 3)
+        if START_BUTTON.collidepoint(mouse_pos):
+            pygame.draw.rect(screen, (100, 255, 100), START_BUTTON, 3)
+        if CONTROLS_BUTTON.collidepoint(mouse_pos):
+            pygame.draw.rect(screen, (100, 100, 255), CONTROLS_BUTTON, 3)
     
     def draw_controls_menu(self):
         screen.fill(GRASS_GREEN)
         
-        font_large = pygame.font.SysFont('arial', 60)
-        title = font_large.render("УПРАВЛЕНИЕ", True, WHITE)
+        title = text_cache.render("УПРАВЛЕНИЕ", 60, WHITE)
         screen.blit(title, (SCREEN_WIDTH//2 - title.get_width()//2, 50))
         
         controls = [
@@ -771,123 +3245,153 @@ class Game:
             "R - съесть ягоды",
             "H - использовать траву",
             "P - выпить зелье",
+            "F5 / F9 - сохранить / загрузить, F3 - замеры",
             "ESC - пауза/меню"
         ]
         
         for i, text in enumerate(controls):
-            control_text = pygame.font.SysFont('arial', 30).render(text, True, WHITE)
+            control_text = text_cache.render(text, 30, WHITE)
             screen.blit(control_text, (SCREEN_WIDTH//2 - control_text.get_width()//2, 150 + i * 40))
         
         # Кнопка "Назад"
-        back_button = pygame.Rect(SCREEN_WIDTH//2 - 100, 600, 200, 50)
-        pygame.draw.rect(screen, RED, back_button)
-        back_text = pygame.font.SysFont('arial', 30).render("Назад", True, WHITE)
-        screen.blit(back_text, (back_button.centerx - back_text.get_width()//2, 
-                              back_button.centery - back_text.get_height()//2))
+        pygame.draw.rect(screen, RED, BACK_BUTTON)
+        back_text = text_cache.render("Назад", 30, WHITE)
+        screen.blit(back_text, (BACK_BUTTON.centerx - back_text.get_width()//2, 
+                              BACK_BUTTON.centery - back_text.get_height()//2))
         
         # Подсветка кнопки при наведении
         mouse_pos = pygame.mouse.get_pos()
-        if back_button.collidepoint(mouse_pos):
-            pygame.draw.rect(screen, (255, 100, 100), back_button, 3)
+        if BACK_BUTTON.collidepoint(mouse_pos):
+            pygame.draw.rect(screen, (255, 100, 100), BACK_BUTTON, 3)
     
-    def draw_wave_info(self):
-        wave_info = self.wave_manager.get_wave_info()
+    def draw_wave_info(self, view):
+        waves = view.wave
+        wave_info = waves.get_wave_info()
         if wave_info:
             # Информация о волне
-            wave_text = pygame.font.SysFont('arial', 24).render(wave_info["description"], True, WHITE)
+            wave_text = text_cache.render(wave_info["description"], 24, WHITE)
             screen.blit(wave_text, (SCREEN_WIDTH//2 - wave_text.get_width()//2, 50))
             
             # Прогресс волны
-            progress_text = pygame.font.SysFont('arial', 20).render(
-                f"Убито: {self.wave_manager.enemies_killed_this_wave}/{wave_info['enemies_to_kill']}", 
-                True, GREEN)
+            progress_text = text_cache.render(
+                f"Убито: {waves.enemies_killed_this_wave}/{wave_info['enemies_to_kill']}", 
+                20, GREEN)
             screen.blit(progress_text, (SCREEN_WIDTH//2 - progress_text.get_width()//2, 80))
             
             # Общее количество убийств
-            total_kills_text = pygame.font.SysFont('arial', 18).render(
-                f"Всего убито: {self.wave_manager.enemies_killed}", 
-                True, LIGHT_GRAY)
+            total_kills_text = text_cache.render(
+                f"Всего убито: {waves.enemies_killed}", 
+                18, LIGHT_GRAY)
             screen.blit(total_kills_text, (SCREEN_WIDTH//2 - total_kills_text.get_width()//2, 105))
         
         # Таймер отдыха между волнами
-        if self.wave_manager.state == "between_waves":
-            remaining_time = self.wave_manager.get_remaining_rest_time()
-            rest_text = pygame.font.SysFont('arial', 28).render(
+        if waves.state == "between_waves":
+            remaining_time = waves.get_remaining_rest_time()
+            rest_text = text_cache.render(
                 f"Отдых: {int(remaining_time)} сек", 
-                True, YELLOW)
+                28, YELLOW)
             screen.blit(rest_text, (SCREEN_WIDTH//2 - rest_text.get_width()//2, 150))
             
-            hint_text = pygame.font.SysFont('arial', 20).render(
+            hint_text = text_cache.render(
                 "Используйте это время для лечения и подготовки", 
-                True, LIGHT_GRAY)
+                20, LIGHT_GRAY)
             screen.blit(hint_text, (SCREEN_WIDTH//2 - hint_text.get_width()//2, 185))
     
-    def draw_game(self):
-        self.texture_manager.draw_grass_background(screen, self.camera)
-        
-        for tree in self.trees:
-            tree.draw(screen, self.camera)
-            
-        for resource in self.resources:
-            resource.draw(screen, self.camera)
+    def draw_game(self, view):
+        self.apply_render_events()
+        
+        # Трава и деревья уже запечены в чанки, поэтому у них одна общая фаза
+        self.perf.start('terrain')
+        self.terrain_cache.draw(screen, self.camera)
+        self.perf.stop('terrain')
+        
+        atlas = self.texture_manager.atlas
+        self.perf.start('resources')
+        camera = self.camera
+        min_x = camera.x - VIEW_MARGIN
+        min_y = camera.y - VIEW_MARGIN
+        max_x = camera.x + camera.width + VIEW_MARGIN
+        max_y = camera.y + camera.height + VIEW_MARGIN
+        
+        pad = atlas.resource_pad
+        areas = atlas.resource_areas
+        drawn_resources = 0
+        for x, y, res_type in view.resources:
+            if min_x <= x < max_x and min_y <= y < max_y:
+                self.render_queue.add('resources', atlas.surface, (x - camera.x - pad, y - camera.y - pad), areas[res_type])
+                drawn_resources += 1
+        self.perf.stop('resources')
             
-        for enemy in self.enemies:
-            enemy.draw(screen, self.camera)
-            
-        self.player.draw(screen, self.camera)
+        self.perf.start('enemies')
+        drawn_enemies = view.enemies.draw(self.render_queue, self.camera, atlas)
+        self.perf.stop('enemies')
         
-        if self.damage_indicator:
-            screen_x, screen_y = self.camera.apply(self.player)
-            color = GREEN if "+" in self.damage_indicator else RED
-            damage_text = pygame.font.SysFont('arial', 24).render(f"{self.damage_indicator}", True, color)
-            screen.blit(damage_text, (screen_x + self.player.size // 2 - damage_text.get_width() // 2, 
+        self.perf.start('submit')
+        self.render_queue.flush(screen)
+        self.perf.stop('submit')
+            
+        self.draw_stats['visited'] = view.resources_visited + len(view.enemies)
+        self.draw_stats['drawn'] = drawn_resources + drawn_enemies
+        
+        player = view.player
+        self.perf.start('player')
+        player.draw(screen, self.camera)
+        
+        if view.damage_indicator:
+            screen_x, screen_y = self.camera.apply_interpolated(player)
+            color = GREEN if "+" in view.damage_indicator else RED
+            damage_text = text_cache.render(f"{view.damage_indicator}", 24, color)
+            screen.blit(damage_text, (screen_x + player.size // 2 - damage_text.get_width() // 2, 
                                     screen_y - 30))
         
-        if self.show_potion_effect:
-            screen_x, screen_y = self.camera.apply(self.player)
+        if view.show_potion_effect:
+            screen_x, screen_y = self.camera.apply_interpolated(player)
             effect_radius = 30
             pygame.draw.circle(screen, LIGHT_BLUE, 
-                             (int(screen_x + self.player.size // 2), int(screen_y + self.player.size // 2)),
+                             (int(screen_x + player.size // 2), int(screen_y + player.size // 2)),
                              effect_radius, 2)
+        self.perf.stop('player')
         
-        self.draw_ui()
+        self.perf.start('ui')
+        self.draw_ui(player)
+        self.perf.stop('ui')
     
-    def draw_ui(self):
+    def draw_ui(self, player):
         bar_width = 200
         bar_height = 20
         
         pygame.draw.rect(screen, RED, (10, 10, bar_width, bar_height))
-        pygame.draw.rect(screen, GREEN, (10, 10, bar_width * (self.player.health / 100), bar_height))
-        health_text = pygame.font.SysFont('arial', 16).render(f"Здоровье: {int(self.player.health)}", True, WHITE)
+        pygame.draw.rect(screen, GREEN, (10, 10, bar_width * (player.health / 100), bar_height))
+        health_text = text_cache.render(f"Здоровье: {int(player.health)}", 16, WHITE)
         screen.blit(health_text, (15, 12))
         
         pygame.draw.rect(screen, RED, (10, 40, bar_width, bar_height))
-        pygame.draw.rect(screen, YELLOW, (10, 40, bar_width * (self.player.hunger / 100), bar_height))
-        hunger_text = pygame.font.SysFont('arial', 16).render(f"Сытость: {int(self.player.hunger)}", True, WHITE)
+        pygame.draw.rect(screen, YELLOW, (10, 40, bar_width * (player.hunger / 100), bar_height))
+        hunger_text = text_cache.render(f"Сытость: {int(player.hunger)}", 16, WHITE)
         screen.blit(hunger_text, (15, 42))
         
         pygame.draw.rect(screen, RED, (10, 70, bar_width, bar_height))
-        pygame.draw.rect(screen, BLUE, (10, 70, bar_width * (self.player.energy / 100), bar_height))
-        energy_text = pygame.font.SysFont('arial', 16).render(f"Энергия: {int(self.player.energy)}", True, WHITE)
+        pygame.draw.rect(screen, BLUE, (10, 70, bar_width * (player.energy / 100), bar_height))
+        energy_text = text_cache.render(f"Энергия: {int(player.energy)}", 16, WHITE)
         screen.blit(energy_text, (15, 72))
         
         inv_y = 100
-        for item, count in self.player.inventory.items():
+        for item, count in player.inventory.items():
             if count > 0:
-                inv_text = pygame.font.SysFont('arial', 16).render(f"{item}: {count}", True, WHITE)
+                inv_text = text_cache.render(f"{item}: {count}", 16, WHITE)
                 screen.blit(inv_text, (15, inv_y))
                 inv_y += 25
                 
-        if self.player.equipped:
-            equip_text = pygame.font.SysFont('arial', 16).render(f"Экипировано: {self.player.equipped}", True, WHITE)
+        if player.equipped:
+            equip_text = text_cache.render(f"Экипировано: {player.equipped}", 16, WHITE)
             screen.blit(equip_text, (15, SCREEN_HEIGHT - 50))
         
-        potion_count = self.player.inventory.get('potion', 0)
-        potion_text = pygame.font.SysFont('arial', 16).render(f"Зелья: {potion_count} (P - использовать)", True, LIGHT_BLUE)
+        potion_count = player.inventory.get('potion', 0)
+        potion_text = text_cache.render(f"Зелья: {potion_count} (P - использовать)", 16, LIGHT_BLUE)
         screen.blit(potion_text, (15, SCREEN_HEIGHT - 30))
         
         if not self.inventory.visible:
-            inv_hint = pygame.font.SysFont('arial', 14).render("Нажмите I для открытия инвентаря", True, LIGHT_GRAY)
+            inv_hint = text_cache.render("Нажмите I для открытия инвентаря", 14, LIGHT_GRAY)
             screen.blit(inv_hint, (SCREEN_WIDTH - 250, SCREEN_HEIGHT - 30))
     
     def draw_pause_menu(self):
@@ -895,25 +3399,20 @@ class Game:
         overlay.fill((0, 0, 0, 180))
         screen.blit(overlay, (0, 0))
         
-        font_large = pygame.font.SysFont('arial', 60)
-        pause_text = font_large.render("ПАУЗА", True, WHITE)
+        pause_text = text_cache.render("ПАУЗА", 60, WHITE)
         screen.blit(pause_text, (SCREEN_WIDTH//2 - pause_text.get_width()//2, 200))
         
-        font_small = pygame.font.SysFont('arial', 30)
-        instruction = font_small.render("Нажмите ESC для продолжения", True, WHITE)
+        instruction = text_cache.render("Нажмите ESC для продолжения", 30, WHITE)
         screen.blit(instruction, (SCREEN_WIDTH//2 - instruction.get_width()//2, 300))
         
-        menu_button = pygame.Rect(SCREEN_WIDTH//2 - 100, 400, 200, 50)
-        pygame.draw.rect(screen, RED, menu_button)
-        menu_text = pygame.font.SysFont('arial', 24).render("В главное меню", True, WHITE)
-        screen.blit(menu_text, (menu_button.centerx - menu_text.get_width()//2, 
-                              menu_button.centery - menu_text.get_height()//2))
+        pygame.draw.rect(screen, RED, PAUSE_MENU_BUTTON)
+        menu_text = text_cache.render("В главное меню", 24, WHITE)
+        screen.blit(menu_text, (PAUSE_MENU_BUTTON.centerx - menu_text.get_width()//2, 
+                              PAUSE_MENU_BUTTON.centery - menu_text.get_height()//2))
         
         mouse_pos = pygame.mouse.get_pos()
-        if menu_button.collidepoint(mouse_pos):
-            pygame.draw.rect(screen, (200, 0, 0), menu_button, 3)
-            if pygame.mouse.get_pressed()[0]:
-                self.show_warning = True
+        if PAUSE_MENU_BUTTON.collidepoint(mouse_pos):
+            pygame.draw.rect(screen, (200, 0, 0), PAUSE_MENU_BUTTON, 3)
     
     def draw_warning(self):
         overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
@@ -924,11 +3423,9 @@ class Game:
         pygame.draw.rect(screen, DARK_GRAY, warning_rect)
         pygame.draw.rect(screen, RED, warning_rect, 3)
         
-        font_large = pygame.font.SysFont('arial', 36)
-        warning_title = font_large.render("ПРЕДУПРЕЖДЕНИЕ", True, RED)
+        warning_title = text_cache.render("ПРЕДУПРЕЖДЕНИЕ", 36, RED)
         screen.blit(warning_title, (SCREEN_WIDTH//2 - warning_title.get_width()//2, 230))
         
-        font_small = pygame.font.SysFont('arial', 24)
         warning_text = [
             "Вы уверены, что хотите вернуться",
             "в главное меню?",
@@ -939,79 +3436,203 @@ class Game:
         ]
         
         for i, text in enumerate(warning_text):
-            text_surface = font_small.render(text, True, WHITE)
+            text_surface = text_cache.render(text, 24, WHITE)
             screen.blit(text_surface, (SCREEN_WIDTH//2 - text_surface.get_width()//2, 300 + i * 30))
         
-        yes_button = pygame.Rect(SCREEN_WIDTH//2 - 120, 450, 100, 40)
-        pygame.draw.rect(screen, RED, yes_button)
-        yes_text = pygame.font.SysFont('arial', 20).render("Да", True, WHITE)
-        screen.blit(yes_text, (yes_button.centerx - yes_text.get_width()//2, 
-                             yes_button.centery - yes_text.get_height()//2))
+        pygame.draw.rect(screen, RED, YES_BUTTON)
+        yes_text = text_cache.render("Да", 20, WHITE)
+        screen.blit(yes_text, (YES_BUTTON.centerx - yes_text.get_width()//2, 
+                             YES_BUTTON.centery - yes_text.get_height()//2))
         
-        no_button = pygame.Rect(SCREEN_WIDTH//2 + 20, 450, 100, 40)
-        pygame.draw.rect(screen, GREEN, no_button)
-        no_text = pygame.font.SysFont('arial', 20).render("Нет", True, WHITE)
-        screen.blit(no_text, (no_button.centerx - no_text.get_width()//2, 
-                            no_button.centery - no_text.get_height()//2))
+        pygame.draw.rect(screen, GREEN, NO_BUTTON)
+        no_text = text_cache.render("Нет", 20, WHITE)
+        screen.blit(no_text, (NO_BUTTON.centerx - no_text.get_width()//2, 
+                            NO_BUTTON.centery - no_text.get_height()//2))
     
     def draw_game_over(self):
         overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
         overlay.fill((0, 0, 0, 180))
         screen.blit(overlay, (0, 0))
         
-        font_large = pygame.font.SysFont('arial', 60)
-        game_over = font_large.render("ИГРА ОКОНЧЕНА", True, RED)
+        game_over = text_cache.render("ИГРА ОКОНЧЕНА", 60, RED)
         screen.blit(game_over, (SCREEN_WIDTH//2 - game_over.get_width()//2, 250))
         
-        font_small = pygame.font.SysFont('arial', 30)
-        restart = font_small.render("Нажмите ENTER для новой игры", True, WHITE)
+        restart = text_cache.render("Нажмите ENTER для новой игры", 30, WHITE)
         screen.blit(restart, (SCREEN_WIDTH//2 - restart.get_width()//2, 350))
     
-    def draw_victory_screen(self):
+    def draw_victory_screen(self, view):
         overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
         overlay.fill((0, 0, 0, 200))
         screen.blit(overlay, (0, 0))
         
-        font_large = pygame.font.SysFont('arial', 60)
-        victory_text = font_large.render("ПОБЕДА!", True, GREEN)
+        victory_text = text_cache.render("ПОБЕДА!", 60, GREEN)
         screen.blit(victory_text, (SCREEN_WIDTH//2 - victory_text.get_width()//2, 150))
         
-        font_medium = pygame.font.SysFont('arial', 36)
-        stats_text = font_medium.render("Статистика:", True, WHITE)
+        stats_text = text_cache.render("Статистика:", 36, WHITE)
         screen.blit(stats_text, (SCREEN_WIDTH//2 - stats_text.get_width()//2, 230))
         
-        total_time = self.wave_manager.get_total_game_time()
+        total_time = view.wave.get_total_game_time()
         minutes = int(total_time // 60)
         seconds = int(total_time % 60)
         
-        font_small = pygame.font.SysFont('arial', 28)
         stats = [
-            f"Всего врагов убито: {self.wave_manager.enemies_killed}",
+            f"Всего врагов убито: {view.wave.enemies_killed}",
             f"Время прохождения: {minutes:02d}:{seconds:02d}",
-            f"Завершено волн: {len(self.wave_manager.waves)}",
+            f"Завершено волн: {len(view.wave.waves)}",
             "",
             "Вы успешно защитили лес!"
         ]
         
         for i, text in enumerate(stats):
-            stat_text = font_small.render(text, True, WHITE)
+            stat_text = text_cache.render(text, 28, WHITE)
             screen.blit(stat_text, (SCREEN_WIDTH//2 - stat_text.get_width()//2, 290 + i * 40))
         
-        font_small = pygame.font.SysFont('arial', 24)
-        restart_text = font_small.render("Нажмите ENTER для новой игры", True, YELLOW)
+        restart_text = text_cache.render("Нажмите ENTER для новой игры", 24, YELLOW)
         screen.blit(restart_text, (SCREEN_WIDTH//2 - restart_text.get_width()//2, 500))
 
-def main():
-    game = Game()
+def run_headless(ticks, input_source=None, seed=None):
+    # Только логика: без окна, без отрисовки и без ограничения FPS
+    if seed is not None:
+        random.seed(seed)
+    game = Game(input_source or BotInput(seed), headless=True)
+    game.start_game()
+    
+    for _ in range(ticks):
+        for key in game.input_source.pop_key_presses():
+            game.handle_key(key)
+        game.update()
+        if game.game_state != "playing":
+            break
+    return game
+
+def run_replay(path, draw=False):
+    # Повтор записанной сессии без окна и без ограничения FPS; draw=True добавляет отрисовку
+    # в dummy-драйвер, чтобы мерить время кадра на настоящем вводе игрока
+    recording = InputRecording.load(path)
+    random.seed(recording.seed)
+    replay_input = ReplayInput(recording)
+    game = Game(replay_input, headless=not draw, world_seed=recording.world_seed)
+    game.start_game()
+    
+    update_times = []
+    draw_times = []
+    while not replay_input.finished() and game.game_state == "playing":
+        for action in replay_input.pop_actions():
+            if action[0] == 'key':
+                game.handle_key(action[1])
+            else:
+                game.craft(action[1], action[2])
+        start = time.perf_counter()
+        game.update()
+        update_times.append((time.perf_counter() - start) * 1000)
+        if draw:
+            start = time.perf_counter()
+            game.draw_frame(*game.capture())
+            draw_times.append((time.perf_counter() - start) * 1000)
+    return game, update_times, draw_times
+
+def main(max_speed_steps=None, world_seed=None, record_path=None, seed=None, telemetry_path=None, telemetry_every=1,
+         threaded=True):
+    init_display()
+    recording = None
+    if record_path:
+        # Весь случайный поток игры должен выводиться из seed, который попадет в запись
+        world_seed = world_seed if world_seed is not None else random.getrandbits(32)
+        seed = seed if seed is not None else random.getrandbits(32)
+        random.seed(seed)
+        recording = InputRecording(seed, world_seed)
+    game = Game(world_seed=world_seed)
+    game.sim_clock.max_speed_steps = max_speed_steps
+    game.autosave = AutosaveWorker()
+    # Запись покрывает одну игру: restart и загрузка сохранения создают игру без recorder
+    game.recorder = recording
+    telemetry = TelemetryWriter(telemetry_path, telemetry_every) if telemetry_path else None
+    # Поток симуляции сам отмеряет шаги и пишет свое время в фазу update
+    game.simulation = SimulationWorker(game) if threaded else None
     running = True
+    frame_ms = 0
     
     while running:
-        running = game.handle_events()
-        game.update()
+        perf = game.perf
+        perf.start('events')
+        with game.sim_lock:
+            running = game.handle_events()
+        perf.stop('events')
+        if game.simulation is None:
+            perf.start('update')
+            for _ in range(game.sim_clock.advance(frame_ms)):
+                game.update()
+            perf.stop('update')
+        perf.start('draw')
         game.draw()
-        clock.tick(FPS)
+        perf.stop('draw')
+        perf.start('tick')
+        frame_ms = clock.tick(FPS)
+        perf.stop('tick')
+        perf.end_frame()
+        if telemetry:
+            telemetry.record(game)
     
+    if game.simulation is not None:
+        game.simulation.close()
+    # Из меню или после конца игры сохранять нечего: иначе настоящая запись затрется пустой игрой
+    if game.game_state in ("playing", "paused"):
+        game.autosave.submit(game.snapshot())
+    game.autosave.close()
+    if telemetry:
+        telemetry.close()
+        print(f"Телеметрия: записано {telemetry.written}, вытеснено из очереди {telemetry.dropped}")
+    if recording is not None:
+        recording.save(record_path)
+        print(f"Записано шагов: {len(recording)}, нажатий: {len(recording.presses)}")
     pygame.quit()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--headless', action='store_true', help="симуляция без окна и отрисовки")
+    parser.add_argument('--games', type=int, default=1)
+    parser.add_argument('--ticks', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--world-seed', type=int, default=None, help="seed генератора мира")
+    parser.add_argument('--speed', type=int, default=None, help="шагов симуляции на каждый кадр (ускоренная перемотка)")
+    parser.add_argument('--record', default=None, help="записать ввод игры в файл")
+    parser.add_argument('--replay', default=None, help="повторить запись без окна на максимальной скорости")
+    parser.add_argument('--telemetry', default=None, help="писать замеры кадров в JSONL-файл")
+    parser.add_argument('--telemetry-every', type=int, default=1, help="записывать каждый N-й кадр")
+    parser.add_argument('--replay-draw', action='store_true', help="при повторе еще и отрисовывать кадры")
+    parser.add_argument('--sync', action='store_true', help="симуляция и отрисовка в одном потоке")
+    args = parser.parse_args()
+    
+    if args.replay:
+        if args.replay_draw:
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+            init_display()
+        else:
+            init_headless()
+        start = time.perf_counter()
+        game, update_times, draw_times = run_replay(args.replay, args.replay_draw)
+        elapsed = time.perf_counter() - start
+        print(f"Повтор: {game.game_state}, волна {game.wave_manager.current_wave}, "
+              f"убито {game.wave_manager.enemies_killed}, здоровье {int(game.player.health)}, "
+              f"позиция ({game.player.x:.0f}, {game.player.y:.0f}), шагов {game.sim_clock.ticks}")
+        for name, samples in (("update", update_times), ("draw", draw_times)):
+            if samples:
+                ordered = sorted(samples)
+                print(f"{name}: mean {sum(ordered) / len(ordered):.3f} мс, "
+                      f"p99 {ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]:.3f} мс")
+        print(f"{len(update_times)} шагов за {elapsed:.2f} с")
+        pygame.quit()
+    elif args.headless:
+        init_headless()
+        start = time.perf_counter()
+        for game_index in range(args.games):
+            seed = None if args.seed is None else args.seed + game_index
+            game = run_headless(args.ticks, seed=seed)
+            print(f"Игра {game_index + 1}: {game.game_state}, волна {game.wave_manager.current_wave}, "
+                  f"убито {game.wave_manager.enemies_killed}, здоровье {int(game.player.health)}")
+        elapsed = time.perf_counter() - start
+        print(f"{args.games} игр за {elapsed:.2f} с")
+        pygame.quit()
+    else:
+        main(args.speed, args.world_seed, args.record, args.seed, args.telemetry, args.telemetry_every,
+             not args.sync)